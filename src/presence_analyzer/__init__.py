@@ -4,3 +4,4 @@ Presence analyzer web app.
 """
 from .main import app
 from . import views
+from . import profiling
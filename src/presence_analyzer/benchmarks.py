@@ -0,0 +1,760 @@
+# -*- coding: utf-8 -*-
+"""
+Performance benchmarks.
+
+Usage: bin/python-console -m presence_analyzer.benchmarks [name ...]
+       [--scale N] [--years N] [--repeat N] [--output results.json]
+       [--baseline baseline.json [--threshold PERCENT] [--update-baseline]]
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import resource
+import shutil
+import argparse
+import datetime
+import tempfile
+import subprocess
+import multiprocessing
+
+from lxml import etree
+
+from presence_analyzer import main as app_main
+from presence_analyzer import utils
+from presence_analyzer import helpers
+from presence_analyzer import columnar
+from presence_analyzer.percentiles import percentile
+
+SAMPLE_DATA_CSV = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'sample_data.csv'
+)
+
+
+def scale_csv(source, path, scale):
+    """
+    Writes contents of source CSV file `scale` times into path.
+    """
+    with open(source, 'rb') as source_file:
+        content = source_file.read()
+    if not content.endswith('\n'):
+        content += '\n'
+    with open(path, 'wb') as output:
+        for _ in xrange(scale):
+            output.write(content)
+    return content.count('\n') * scale
+
+
+def write_synthetic_csv(path, users, days, seed=0):
+    """
+    Writes deterministic presence CSV with `users` x `days` rows.
+    """
+    rand = random.Random(seed)
+    first = datetime.date(2011, 1, 3).toordinal()
+    with open(path, 'wb') as output:
+        for user_id in xrange(1, users + 1):
+            for day in xrange(first, first + days):
+                start = rand.randint(7 * 3600, 11 * 3600)
+                end = start + rand.randint(3600, 9 * 3600)
+                output.write('{0},{1},{2:02d}:{3:02d}:{4:02d},'
+                             '{5:02d}:{6:02d}:{7:02d}\n'.format(
+                                 user_id,
+                                 datetime.date.fromordinal(day).isoformat(),
+                                 start // 3600, start // 60 % 60, start % 60,
+                                 end // 3600, end // 60 % 60, end % 60))
+    return users * days
+
+
+def write_synthetic_xml(path, users):
+    """
+    Writes users XML file with given number of users.
+    """
+    with open(path, 'wb') as output:
+        output.write(
+            '<intranet>\n    <server>\n'
+            '        <host>intranet.example.com</host>\n'
+            '        <port>443</port>\n'
+            '        <protocol>https</protocol>\n'
+            '    </server>\n    <users>\n'
+        )
+        for user_id in xrange(1, users + 1):
+            output.write(
+                '        <user id="{0}">\n'
+                '            <avatar>/api/images/users/{0}</avatar>\n'
+                '            <name>User {0}</name>\n'
+                '        </user>\n'.format(user_id)
+            )
+        output.write('    </users>\n</intranet>\n')
+    return users
+
+
+def write_synthetic_data(directory, users, years, seed=0):
+    """
+    Writes deterministic DATA_CSV and USERS_XML files into directory,
+    with presence of `users` users over `years` years.
+
+    Returns (CSV path, XML path).
+    """
+    csv_path = os.path.join(directory, 'data.csv')
+    xml_path = os.path.join(directory, 'users.xml')
+    write_synthetic_csv(csv_path, users, years * 365, seed=seed)
+    write_synthetic_xml(xml_path, users)
+    return csv_path, xml_path
+
+
+def summary(samples):
+    """
+    Describes timing samples in seconds.
+    """
+    return {
+        'samples': len(samples),
+        'min': min(samples),
+        'median': percentile(samples, 0.5),
+        'p95': percentile(samples, 0.95),
+        'mean': sum(samples) / len(samples),
+    }
+
+
+def rss():
+    """
+    Returns resident set size of current process in bytes (Linux only).
+    """
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def max_rss():
+    """
+    Returns peak resident set size of current process in bytes (Linux only).
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _measure(queue, function, args):
+    """
+    Puts memory growth, peak growth and duration of function call into queue.
+    """
+    before = rss()
+    started = time.time()
+    result = function(*args)
+    elapsed = time.time() - started
+    queue.put((rss() - before, max_rss() - before, elapsed))
+    del result
+
+
+def measured(function, *args):
+    """
+    Runs function in fresh process.
+
+    Returns (memory growth, peak memory growth, seconds).
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=_measure, args=(queue, function, args)
+    )
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def timed(function, *args, **kwargs):
+    """
+    Returns wall time in seconds of single function call.
+    """
+    started = time.time()
+    function(*args, **kwargs)
+    return time.time() - started
+
+
+def bench_parser(scale=100):
+    """
+    Compares rows/second of strict and fast CSV row parsers.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'data.csv')
+        rows = scale_csv(SAMPLE_DATA_CSV, path, scale)
+        results = {}
+        for name, parse in (('strict', utils.parse_row_strict),
+                            ('fast', utils.parse_row)):
+            with open(path, 'rb') as csvfile:
+                elapsed = timed(utils.read_data, csvfile, parse=parse)
+            results[name] = {
+                'rows': rows,
+                'seconds': elapsed,
+                'rows_per_second': rows / elapsed,
+            }
+        return results
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _load_dict(path):
+    """
+    Loads CSV into get_data() structure.
+    """
+    with open(path, 'rb') as csvfile:
+        return utils.read_data(csvfile)
+
+
+def _load_columnar(path):
+    """
+    Loads CSV into columnar store.
+    """
+    with open(path, 'rb') as csvfile:
+        return columnar.ColumnarStore.from_rows(utils.iter_rows(csvfile))
+
+
+def _each_user_dict(data):
+    """
+    Computes weekday aggregates of every user one by one.
+    """
+    for user_id in data:
+        helpers.weekday_aggregates(data[user_id])
+
+
+def _each_user_columnar(store):
+    """
+    Computes weekday aggregates of every user one by one.
+    """
+    for user_id in store.users.tolist():
+        store.weekday_aggregates(user_id)
+
+
+def bench_columnar(scale=100):
+    """
+    Compares memory and latency of dict and columnar presence stores.
+
+    Uses synthetic data with 1000 users and `scale` * 10 days each, 1M rows
+    by default.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'data.csv')
+        rows = write_synthetic_csv(path, 1000, scale * 10)
+        dict_memory, _, dict_load = measured(_load_dict, path)
+        columnar_memory, _, columnar_load = measured(_load_columnar, path)
+
+        data = _load_dict(path)
+        dict_aggregates = timed(utils.build_aggregates, data)
+        dict_user = timed(_each_user_dict, data) / len(data)
+        del data
+
+        store = _load_columnar(path)
+        columnar_aggregates = timed(store.aggregates)
+        columnar_user = timed(_each_user_columnar, store) / len(store.users)
+
+        return {
+            'dict': {
+                'rows': rows,
+                'memory_bytes': dict_memory,
+                'load_seconds': dict_load,
+                'aggregates_seconds': dict_aggregates,
+                'user_aggregates_seconds': dict_user,
+            },
+            'columnar': {
+                'rows': rows,
+                'memory_bytes': columnar_memory,
+                'array_bytes': store.nbytes(),
+                'load_seconds': columnar_load,
+                'aggregates_seconds': columnar_aggregates,
+                'user_aggregates_seconds': columnar_user,
+            },
+        }
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _parse_users_dom(path):
+    """
+    Loads users XML building full DOM first, like get_user_data used to.
+    """
+    user_data = {}
+    with open(path, 'rb') as xmlfile:
+        root = etree.parse(xmlfile).getroot()
+        host = root.find('server/host').text
+        protocol = root.find('server/protocol').text
+        for element in root.find('users').iterchildren():
+            user_data[int(element.get('id'))] = {
+                'avatar': '{0}://{1}{2}'.format(
+                    protocol, host, element.find('avatar').text
+                ),
+                'name': element.find('name').text,
+            }
+    return user_data
+
+
+def _parse_users_stream(path):
+    """
+    Loads users XML with streaming parser.
+    """
+    with open(path, 'rb') as xmlfile:
+        return dict(utils.iter_user_data(xmlfile))
+
+
+def _count_users_stream(path):
+    """
+    Consumes streamed users without keeping them.
+    """
+    with open(path, 'rb') as xmlfile:
+        return sum(1 for _ in utils.iter_user_data(xmlfile))
+
+
+def bench_users_xml(scale=100):
+    """
+    Compares DOM and streaming users XML loaders.
+
+    Uses synthetic file with `scale` * 1000 users, 100k by default.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'users.xml')
+        users = write_synthetic_xml(path, scale * 1000)
+        results = {}
+        for name, function in (('dom', _parse_users_dom),
+                               ('iterparse', _parse_users_stream),
+                               ('iterparse_no_dict', _count_users_stream)):
+            _, peak, elapsed = measured(function, path)
+            results[name] = {
+                'users': users,
+                'peak_memory_bytes': peak,
+                'seconds': elapsed,
+            }
+        return results
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _load_parallel(path, workers):
+    """
+    Loads CSV into get_data() structure using worker processes.
+    """
+    return utils.columns_to_data(*utils.read_columns_parallel(path, workers))
+
+
+def bench_parallel(scale=100):
+    """
+    Measures CSV loading time with 1, 2, 4 and 8 worker processes.
+
+    Uses synthetic data with 1000 users and `scale` * 10 days each, 1M rows
+    by default.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'data.csv')
+        rows = write_synthetic_csv(path, 1000, scale * 10)
+        results = {
+            'serial': {
+                'rows': rows,
+                'seconds': timed(_load_dict, path),
+                'cpus': multiprocessing.cpu_count(),
+            },
+        }
+        for workers in (1, 2, 4, 8):
+            elapsed = timed(_load_parallel, path, workers)
+            results['workers_{0}'.format(workers)] = {
+                'rows': rows,
+                'seconds': elapsed,
+                'speedup': results['serial']['seconds'] / elapsed,
+            }
+        return results
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_json(scale=100):
+    """
+    Measures serialization of all-users listing with each JSON backend.
+
+    Uses synthetic listing of `scale` * 100 users, 10k by default.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'users.xml')
+        write_synthetic_xml(path, scale * 100)
+        with open(path, 'rb') as xmlfile:
+            listing = [
+                {
+                    'user_id': user_id,
+                    'name': user_data['name'],
+                    'avatar': user_data['avatar'],
+                }
+                for user_id, user_data in utils.iter_user_data(xmlfile)
+            ]
+    finally:
+        shutil.rmtree(tmpdir)
+
+    results = {}
+    backends = helpers.JSON_BACKENDS + [('json_default', json.dumps)]
+    for name, dumps in backends:
+        body = dumps(listing)
+        results[name] = {
+            'users': len(listing),
+            'bytes': len(body),
+            'seconds': min(timed(dumps, listing) for _ in xrange(5)),
+        }
+    body = helpers.JSON_BACKENDS[0][1](listing)
+    for name, wbits in (('gzip', 16 + zlib.MAX_WBITS),
+                        ('deflate', zlib.MAX_WBITS)):
+        started = time.time()
+        compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+        compressed = compressor.compress(body) + compressor.flush()
+        results[name] = {
+            'bytes': len(compressed),
+            'seconds': time.time() - started,
+        }
+    return results
+
+
+SUITE_URLS = (
+    '/api/v1/users',
+    '/api/v1/mean_time_weekday/{user_id}',
+    '/api/v1/presence_weekday/{user_id}',
+    '/api/v1/presence_start_end/{user_id}',
+    '/api/v1/stats?users=all',
+    '/api/v1/presence_totals?period=monthly',
+)
+
+
+def _cold(function):
+    """
+    Calls function with empty data cache.
+    """
+    utils.clear_cache()
+    return function()
+
+
+def _each_user(function, data):
+    """
+    Calls function with presence entries of every user.
+    """
+    for items in data.itervalues():
+        function(items)
+
+
+def _get(client, url):
+    """
+    Requests URL with empty response cache.
+    """
+    helpers.RESPONSE_CACHE.clear()
+    response = client.get(url)
+    if response.status_code != 200:
+        raise RuntimeError('{0} returned {1}'.format(url, response.status))
+
+
+def bench_suite(scale=100, years=2, repeat=20):
+    """
+    Times data loaders, weekday helpers and /api/v1 views.
+
+    Uses synthetic data of `scale` users over `years` years. Each
+    benchmark is run `repeat` times after a warm up run, loaders with
+    empty data cache and views with empty response cache.
+    """
+    app = app_main.app
+    tmpdir = tempfile.mkdtemp()
+    settings = ('DATA_CSV', 'USERS_XML', 'DATA_SNAPSHOT')
+    saved = dict((key, app.config.get(key)) for key in settings)
+    try:
+        csv_path, xml_path = write_synthetic_data(tmpdir, scale, years)
+        app.config.update(
+            DATA_CSV=csv_path, USERS_XML=xml_path, DATA_SNAPSHOT=None
+        )
+        benchmarks = [
+            ('get_data', _cold, (utils.get_data,)),
+            ('get_user_data', _cold, (utils.get_user_data,)),
+            ('group_by_weekday', _each_user,
+             (helpers.group_by_weekday, utils.get_data())),
+            ('group_start_end_times_by_weekday', _each_user,
+             (helpers.group_start_end_times_by_weekday, utils.get_data())),
+        ]
+        client = app.test_client()
+        user_id = min(utils.get_data())
+        benchmarks += [
+            ('view:' + url, _get, (client, url.format(user_id=user_id)))
+            for url in SUITE_URLS
+        ]
+
+        results = {}
+        for name, function, args in benchmarks:
+            # first run fills caches not under test
+            function(*args)
+            samples = [timed(function, *args) for _ in xrange(repeat)]
+            results[name] = summary(samples)
+        return results
+    finally:
+        app.config.update(saved)
+        utils.clear_cache()
+        helpers.RESPONSE_CACHE.clear()
+        shutil.rmtree(tmpdir)
+
+
+IMPORT_SCRIPT = """
+import sys, json
+from timeit import default_timer as timer
+started = timer()
+for name in sys.argv[1:]:
+    __import__(name)
+print json.dumps([timer() - started, sorted(sys.modules)])
+"""
+
+
+def import_modules(*modules):
+    """
+    Imports modules in fresh interpreter.
+
+    Returns (seconds, names of all modules loaded by the import).
+    """
+    output = subprocess.check_output(
+        [sys.executable, '-c', IMPORT_SCRIPT] + list(modules),
+        cwd=os.path.join(os.path.dirname(__file__), '..'),
+    )
+    seconds, loaded = json.loads(output)
+    return seconds, loaded
+
+
+def bench_startup(scale=100):
+    """
+    Measures import time of WSGI app and flask-ctl entry points.
+
+    Best of `scale` / 10 fresh interpreters.
+    """
+    results = {}
+    for name, modules in (('app', ['presence_analyzer']),
+                          ('script', ['presence_analyzer.script'])):
+        runs = [import_modules(*modules) for _ in xrange(max(scale // 10, 1))]
+        results[name] = {
+            'seconds': min(seconds for seconds, _ in runs),
+            'modules': len(runs[0][1]),
+        }
+    return results
+
+
+BENCHMARKS = {
+    'parser': bench_parser,
+    'columnar': bench_columnar,
+    'users_xml': bench_users_xml,
+    'parallel': bench_parallel,
+    'startup': bench_startup,
+    'json': bench_json,
+    'suite': bench_suite,
+}
+
+
+def report(name, results):
+    """
+    Prints benchmark results as a table.
+    """
+    print name
+    for variant, result in sorted(results.items()):
+        print '  {0:<20} {1}'.format(
+            variant,
+            ', '.join(
+                '{0}={1:.6g}'.format(key, value)
+                for key, value in sorted(result.items())
+            )
+        )
+
+
+def run(names, scale=100, years=2, repeat=20):
+    """
+    Runs benchmarks, returns {name: results}.
+
+    `years` and `repeat` apply to the suite only.
+    """
+    results = {}
+    for name in names:
+        if name == 'suite':
+            results[name] = bench_suite(scale, years=years, repeat=repeat)
+        else:
+            results[name] = BENCHMARKS[name](scale=scale)
+    return results
+
+
+def write_results(path, results, **options):
+    """
+    Writes results with options they were run with as JSON.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'wb') as output:
+        json.dump(
+            {'options': options, 'results': results},
+            output, indent=2, sort_keys=True
+        )
+
+
+# absolute differences below that many seconds are never regressions
+NOISE_FLOOR = 0.0005
+
+
+def compare(baseline, current, threshold=10.0):
+    """
+    Compares median and p95 of benchmarks present in both results.
+
+    Median regresses when it grows by more than `threshold` percent and
+    by more than baseline spread between median and p95. p95 is noisier,
+    it regresses when it grows by more than twice `threshold` percent.
+    Differences under NOISE_FLOOR seconds are ignored.
+
+    Returns rows of (name, baseline median, median, baseline p95, p95,
+    status) with status 'ok', 'faster', 'slower', 'new' or 'missing'.
+    """
+    rows = []
+    old = _timings(baseline)
+    new = _timings(current)
+    for name in sorted(set(old) | set(new)):
+        if name not in new:
+            rows.append((name, old[name]['median'], None,
+                         old[name]['p95'], None, 'missing'))
+            continue
+        if name not in old:
+            rows.append((name, None, new[name]['median'],
+                         None, new[name]['p95'], 'new'))
+            continue
+        base, result = old[name], new[name]
+        median_limit = max(base['median'] * threshold / 100.0,
+                           base['p95'] - base['median'], NOISE_FLOOR)
+        p95_limit = max(base['p95'] * 2 * threshold / 100.0, NOISE_FLOOR)
+        median_change = result['median'] - base['median']
+        if (median_change > median_limit or
+                result['p95'] - base['p95'] > p95_limit):
+            status = 'slower'
+        elif -median_change > median_limit:
+            status = 'faster'
+        else:
+            status = 'ok'
+        rows.append((name, base['median'], result['median'],
+                     base['p95'], result['p95'], status))
+    return rows
+
+
+def _timings(results):
+    """
+    Flattens {benchmark: {variant: summary}} results into
+    {'benchmark.variant': summary} for variants with median and p95.
+    """
+    return dict(
+        ('{0}.{1}'.format(name, variant), result)
+        for name, variants in results.items()
+        for variant, result in variants.items()
+        if 'median' in result and 'p95' in result
+    )
+
+
+def _change(old, new):
+    """
+    Formats relative change between two values.
+    """
+    if old is None or new is None:
+        return ''
+    if not old:
+        return 'n/a'
+    return '{0:+.1f}%'.format((new - old) * 100.0 / old)
+
+
+def diff_table(rows):
+    """
+    Formats comparison rows as a table, times in milliseconds.
+    """
+    def ms(value):
+        return '' if value is None else '{0:.3f}'.format(value * 1000)
+
+    width = max([len(row[0]) for row in rows] + [9])
+    lines = ['{0:<{w}} {1:>10} {2:>10} {3:>8} {4:>10} {5:>10} {6:>8}  {7}'
+             .format('benchmark', 'median', 'was', '', 'p95', 'was', '',
+                     'status', w=width)]
+    for name, old_median, median, old_p95, p95, status in rows:
+        lines.append(
+            '{0:<{w}} {1:>10} {2:>10} {3:>8} {4:>10} {5:>10} {6:>8}  {7}'
+            .format(name, ms(median), ms(old_median),
+                    _change(old_median, median), ms(p95), ms(old_p95),
+                    _change(old_p95, p95), status, w=width)
+        )
+    return '\n'.join(lines)
+
+
+def check(baseline_path, threshold=10.0, update=False, **options):
+    """
+    Runs benchmarks stored in baseline file and compares results with it.
+
+    Benchmarks run with options stored in baseline, unless given. Missing
+    baseline is created, as well as with `update`. Returns exit status,
+    1 when any benchmark got slower.
+    """
+    if update or not os.path.exists(baseline_path):
+        options = dict(
+            {'scale': 100, 'years': 2, 'repeat': 20, 'names': ['suite']},
+            **dict((key, value) for key, value in options.items()
+                   if value is not None)
+        )
+        names = options.pop('names')
+        results = run(names, **options)
+        write_results(baseline_path, results, **options)
+        print 'Wrote baseline {0}'.format(baseline_path)
+        return 0
+
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    run_options = dict(baseline['options'])
+    run_options.update(
+        (key, value) for key, value in options.items() if value is not None
+    )
+    names = run_options.pop('names', None) or sorted(baseline['results'])
+    results = run(names, **run_options)
+    rows = compare(baseline['results'], results, threshold)
+    print diff_table(rows)
+    slower = [row[0] for row in rows if row[-1] == 'slower']
+    if slower:
+        print '{0} benchmark(s) slower than baseline by more than ' \
+            '{1}%: {2}'.format(len(slower), threshold, ', '.join(slower))
+        return 1
+    return 0
+
+
+def main(argv=None):
+    """
+    Runs selected benchmarks.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help=', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--scale', type=int)
+    parser.add_argument('--years', type=int,
+                        help='years of synthetic data in suite')
+    parser.add_argument('--repeat', type=int,
+                        help='runs of each suite benchmark')
+    parser.add_argument('--output', help='write results as JSON')
+    parser.add_argument('--baseline',
+                        help='compare with results stored in JSON file')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='percent of slowdown failing comparison')
+    parser.add_argument('--update-baseline', action='store_true')
+    args = parser.parse_args(argv)
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmark: {0}'.format(', '.join(unknown)))
+    if args.baseline:
+        # options not given come from baseline file
+        return check(args.baseline, args.threshold, args.update_baseline,
+                     names=args.names or None, scale=args.scale,
+                     years=args.years, repeat=args.repeat)
+
+    options = {
+        'scale': args.scale or 100,
+        'years': args.years or 2,
+        'repeat': args.repeat or 20,
+    }
+    names = args.names or sorted(BENCHMARKS)
+    results = run(names, **options)
+    for name in names:
+        report(name, results[name])
+    if args.output:
+        write_results(args.output, results, **options)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar presence data store backed by NumPy arrays.
+"""
+
+from array import array
+from datetime import date, time
+
+# imported on first use, see load_numpy
+numpy = None  # pylint: disable-msg=C0103
+
+
+def load_numpy():
+    """
+    Imports numpy, returns None if it is not installed.
+    """
+    global numpy  # pylint: disable-msg=W0603,C0103
+    if numpy is None:
+        try:
+            import numpy as module
+        except ImportError:  # pragma: no cover
+            return None
+        numpy = module
+    return numpy
+
+
+def seconds(value):
+    """
+    Converts datetime.time into seconds since midnight.
+    """
+    return value.hour * 3600 + value.minute * 60 + value.second
+
+
+class ColumnarStore(object):
+    """
+    Presence entries kept in parallel int32 arrays sorted by user and day.
+
+    `user_ids`, `days` (date ordinals), `starts` and `ends` (seconds since
+    midnight) hold one entry per row. Rows of `users[i]` are the slice
+    `offsets[i]:offsets[i + 1]`.
+    """
+
+    def __init__(self, user_ids, days, starts, ends):
+        if load_numpy() is None:
+            raise RuntimeError('ColumnarStore requires numpy')
+
+        user_ids = numpy.asarray(user_ids, dtype=numpy.int32)
+        days = numpy.asarray(days, dtype=numpy.int32)
+        # stable sort keeps input order of duplicated (user, day) rows
+        order = numpy.lexsort((days, user_ids))
+        user_ids = user_ids[order]
+        days = days[order]
+        # last row wins, same as overwriting dict entries
+        last = numpy.ones(len(order), dtype=bool)
+        last[:-1] = (user_ids[1:] != user_ids[:-1]) | (days[1:] != days[:-1])
+        order = order[last]
+
+        self.user_ids = user_ids[last]
+        self.days = days[last]
+        self.starts = numpy.asarray(starts, dtype=numpy.int32)[order]
+        self.ends = numpy.asarray(ends, dtype=numpy.int32)[order]
+        self.users, first = numpy.unique(self.user_ids, return_index=True)
+        self.offsets = numpy.append(first, len(self.user_ids))
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def __contains__(self, user_id):
+        index = numpy.searchsorted(self.users, user_id)
+        return index < len(self.users) and self.users[index] == user_id
+
+    @classmethod
+    def from_data(cls, data):
+        """
+        Builds store from utils.get_data() structure.
+        """
+        user_ids, days, starts, ends = (array('i') for _ in range(4))
+        for user_id, items in data.iteritems():
+            for day, start_end in items.iteritems():
+                user_ids.append(user_id)
+                days.append(day.toordinal())
+                starts.append(seconds(start_end['start']))
+                ends.append(seconds(start_end['end']))
+        return cls(user_ids, days, starts, ends)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Builds store from (user_id, date, start, end) tuples.
+
+        See utils.iter_rows.
+        """
+        user_ids, days, starts, ends = (array('i') for _ in range(4))
+        for user_id, day, start, end in rows:
+            user_ids.append(user_id)
+            days.append(day.toordinal())
+            starts.append(seconds(start))
+            ends.append(seconds(end))
+        return cls(user_ids, days, starts, ends)
+
+    @classmethod
+    def from_sorted(cls, user_ids, days, starts, ends, users, offsets):
+        """
+        Wraps columns already sorted by user and day without copying them.
+        """
+        if load_numpy() is None:
+            raise RuntimeError('ColumnarStore requires numpy')
+
+        store = cls.__new__(cls)
+        store.user_ids = user_ids
+        store.days = days
+        store.starts = starts
+        store.ends = ends
+        store.users = users
+        store.offsets = offsets
+        return store
+
+    def to_data(self):
+        """
+        Converts store back into utils.get_data() structure.
+        """
+        data = {}
+        for user_id, day, start, end in zip(self.user_ids.tolist(),
+                                            self.days.tolist(),
+                                            self.starts.tolist(),
+                                            self.ends.tolist()):
+            data.setdefault(user_id, {})[date.fromordinal(day)] = {
+                'start': time(start // 3600, start // 60 % 60, start % 60),
+                'end': time(end // 3600, end // 60 % 60, end % 60),
+            }
+        return data
+
+    def user_slice(self, user_id):
+        """
+        Returns slice of rows belonging to given user.
+        """
+        index = numpy.searchsorted(self.users, user_id)
+        if index == len(self.users) or self.users[index] != user_id:
+            return slice(0, 0)
+        return slice(self.offsets[index], self.offsets[index + 1])
+
+    def weekdays(self, rows=slice(None)):
+        """
+        Returns weekday (Monday is 0) of given rows.
+        """
+        # date.fromordinal(1) is a Monday
+        return (self.days[rows] - 1) % 7
+
+    def group_by_weekday(self, user_id):
+        """
+        Groups presence intervals of given user by weekday.
+        """
+        rows = self.user_slice(user_id)
+        weekdays = self.weekdays(rows)
+        intervals = self.ends[rows] - self.starts[rows]
+        return {i: intervals[weekdays == i] for i in range(7)}
+
+    def weekday_aggregates(self, user_id, first=None, last=None):
+        """
+        Sums presence entries of given user by weekday, optionally limited
+        to dates between first and last (inclusive).
+
+        Same result as helpers.weekday_aggregates.
+        """
+        rows = self.user_slice(user_id)
+        if first is not None or last is not None:
+            days = self.days[rows]
+            start = rows.start
+            if first is not None:
+                start += numpy.searchsorted(days, first.toordinal())
+            stop = rows.start + len(days)
+            if last is not None:
+                stop = rows.start + numpy.searchsorted(
+                    days, last.toordinal(), side='right'
+                )
+            rows = slice(start, stop)
+        return self._aggregate(self.weekdays(rows), rows, 7).tolist()
+
+    def aggregates(self):
+        """
+        Weekday aggregates of all users, same as utils.build_aggregates.
+        """
+        user_index = numpy.repeat(
+            numpy.arange(len(self.users)), numpy.diff(self.offsets)
+        )
+        groups = user_index * 7 + self.weekdays()
+        result = self._aggregate(groups, slice(None), len(self.users) * 7)
+        result = result.reshape(len(self.users), 7, 4).tolist()
+        return dict(zip(self.users.tolist(), result))
+
+    def _aggregate(self, groups, rows, size):
+        """
+        Returns [count, total, start sum, end sum] rows for each group.
+        """
+        starts = self.starts[rows].astype(numpy.int64)
+        ends = self.ends[rows].astype(numpy.int64)
+        result = numpy.zeros((size, 4), dtype=numpy.int64)
+        result[:, 0] = numpy.bincount(groups, minlength=size)
+        for column, values in ((1, ends - starts), (2, starts), (3, ends)):
+            result[:, column] = numpy.bincount(
+                groups, weights=values, minlength=size
+            )
+        return result
+
+    def mean_by_weekday(self, user_id):
+        """
+        Mean presence interval of given user by weekday.
+        """
+        aggregates = numpy.array(self.weekday_aggregates(user_id))
+        counts = aggregates[:, 0]
+        return numpy.where(
+            counts > 0,
+            aggregates[:, 1] / numpy.maximum(counts, 1).astype(float),
+            0,
+        )
+
+    def sum_by_weekday(self, user_id):
+        """
+        Total presence interval of given user by weekday.
+        """
+        return numpy.array(self.weekday_aggregates(user_id))[:, 1]
+
+    def nbytes(self):
+        """
+        Memory used by store arrays.
+        """
+        return sum(
+            column.nbytes
+            for column in (self.user_ids, self.days, self.starts,
+                           self.ends, self.users, self.offsets)
+        )
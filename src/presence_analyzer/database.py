@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite presence store, used with STORAGE_BACKEND = "sqlite".
+
+Rows of DATA_CSV and users of USERS_XML are imported into DATABASE file,
+rows appended to DATA_CSV incrementally. Weekday aggregates are computed
+by SQL queries using (user_id, date) index instead of keeping all data
+in memory of every process.
+"""
+
+import sqlite3
+import itertools
+import threading
+from collections import Mapping
+from contextlib import contextmanager
+from datetime import date, time
+
+from presence_analyzer import utils
+from presence_analyzer import helpers
+from presence_analyzer import columnar
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS presence (
+    user_id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    start_time INTEGER NOT NULL,
+    end_time INTEGER NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS presence_user_date
+    ON presence (user_id, date);
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    name TEXT,
+    avatar TEXT
+);
+CREATE TABLE IF NOT EXISTS sources (
+    path TEXT PRIMARY KEY,
+    offset INTEGER,
+    tail BLOB,
+    version TEXT
+);
+"""
+
+# weekday of ISO date column, Monday is 0
+WEEKDAY = "(CAST(strftime('%w', date) AS INTEGER) + 6) % 7"
+
+_local = threading.local()
+
+
+def connect(path):
+    """
+    Returns connection to database owned by current thread.
+
+    Threads of server threadpool keep their connections between requests.
+    """
+    connections = _local.__dict__.setdefault('connections', {})
+    connection = connections.get(path)
+    if connection is None:
+        connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+        # readers do not wait for import in progress
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.executescript(SCHEMA)
+        connections[path] = connection
+    return connection
+
+
+def close(path):
+    """
+    Closes connection of current thread to database.
+    """
+    connection = getattr(_local, 'connections', {}).pop(path, None)
+    if connection is not None:
+        connection.close()
+
+
+@contextmanager
+def transaction(connection):
+    """
+    Runs block in transaction holding database write lock.
+    """
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        yield connection
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+    connection.execute('COMMIT')
+
+
+def import_csv(connection, path, full=False):
+    """
+    Imports rows appended to CSV file since previous import.
+
+    All rows are imported again when file was truncated or rewritten,
+    or with `full`. Unterminated last line is imported by full import
+    only, appended rows skip it until it is finished. Returns number
+    of imported rows.
+    """
+    with transaction(connection), open(path, 'rb') as csvfile:
+        source = connection.execute(
+            'SELECT offset, tail FROM sources WHERE path = ?', (path,)
+        ).fetchone()
+        offset, tail = (source[0], str(source[1])) if source else (0, '')
+        if offset and not full:
+            csvfile.seek(offset - len(tail))
+            full = csvfile.read(len(tail)) != tail
+        if full or not offset:
+            offset, tail = 0, ''
+            connection.execute('DELETE FROM presence')
+
+        csvfile.seek(offset)
+        state = {'offset': offset, 'tail': tail}
+        cursor = connection.executemany(
+            'INSERT OR REPLACE INTO presence VALUES (?, ?, ?, ?)',
+            (
+                (user_id, day.isoformat(),
+                 columnar.seconds(start), columnar.seconds(end))
+                for user_id, day, start, end in utils.iter_rows(
+                    utils.track_lines(csvfile, state, unfinished=not offset)
+                )
+            )
+        )
+        connection.execute(
+            'INSERT OR REPLACE INTO sources (path, offset, tail) '
+            'VALUES (?, ?, ?)',
+            (path, state['offset'], sqlite3.Binary(state['tail']))
+        )
+    # -1 when there was nothing to insert
+    return max(cursor.rowcount, 0)
+
+
+def import_users(connection, path):
+    """
+    Replaces users with ones from users XML file, if it changed since
+    previous import. Returns number of imported users.
+    """
+    version = repr(utils.file_version(path))
+    with transaction(connection):
+        source = connection.execute(
+            'SELECT version FROM sources WHERE path = ?', (path,)
+        ).fetchone()
+        if source is not None and source[0] == version:
+            return 0
+        connection.execute('DELETE FROM users')
+        with open(path, 'rb') as xmlfile:
+            cursor = connection.executemany(
+                'INSERT INTO users VALUES (?, ?, ?)',
+                (
+                    (user_id, user_data['name'], user_data['avatar'])
+                    for user_id, user_data in utils.iter_user_data(xmlfile)
+                )
+            )
+        connection.execute(
+            'INSERT OR REPLACE INTO sources (path, version) VALUES (?, ?)',
+            (path, version)
+        )
+    return max(cursor.rowcount, 0)
+
+
+def _date(value):
+    """
+    Parses ISO date column.
+    """
+    year, month, day = value.split('-')
+    return date(int(year), int(month), int(day))
+
+
+def _time(seconds):
+    """
+    Converts seconds since midnight into datetime.time.
+    """
+    return time(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def weekday_aggregates(connection, user_id, first=None, last=None):
+    """
+    Sums presence entries of given user by weekday, optionally limited
+    to dates between first and last (inclusive).
+
+    Same result as helpers.weekday_aggregates.
+    """
+    query = (
+        'SELECT {0}, COUNT(*), SUM(end_time - start_time), '
+        'SUM(start_time), SUM(end_time) FROM presence WHERE user_id = ?'
+    ).format(WEEKDAY)
+    params = [user_id]
+    if first is not None:
+        query += ' AND date >= ?'
+        params.append(first.isoformat())
+    if last is not None:
+        query += ' AND date <= ?'
+        params.append(last.isoformat())
+    result = [[0, 0, 0, 0] for _ in range(7)]
+    for row in connection.execute(query + ' GROUP BY 1', params):
+        result[row[0]] = list(row[1:])
+    return result
+
+
+def timeline(connection, user_ids=None):
+    """
+    Builds company-wide timeline of daily presence, or timeline of given
+    users, see helpers.timeline.
+    """
+    query = 'SELECT date, SUM(end_time - start_time), COUNT(*) FROM presence'
+    if user_ids is None:
+        rows = connection.execute(query + ' GROUP BY date')
+    else:
+        rows = itertools.chain.from_iterable(
+            connection.execute(
+                query + ' WHERE user_id = ? GROUP BY date', (user_id,)
+            )
+            for user_id in user_ids
+        )
+    return helpers.timeline(
+        (_date(day).toordinal(), total, count) for day, total, count in rows
+    )
+
+
+def to_data(connection):
+    """
+    Builds utils.get_data() structure from imported rows.
+    """
+    data = {}
+    for user_id, day, start, end in connection.execute(
+            'SELECT user_id, date, start_time, end_time FROM presence'):
+        data.setdefault(user_id, {})[_date(day)] = {
+            'start': _time(start),
+            'end': _time(end),
+        }
+    return data
+
+
+def users(connection):
+    """
+    Returns imported users, same structure as utils.get_user_data().
+    """
+    return dict(
+        (user_id, {'name': name, 'avatar': avatar})
+        for user_id, name, avatar in connection.execute(
+            'SELECT user_id, name, avatar FROM users'
+        )
+    )
+
+
+class Aggregates(Mapping):
+    """
+    Read-only {user_id: weekday aggregates} mapping querying database,
+    usable in place of utils.build_aggregates() result.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __contains__(self, user_id):
+        return connect(self.path).execute(
+            'SELECT 1 FROM presence WHERE user_id = ? LIMIT 1', (user_id,)
+        ).fetchone() is not None
+
+    def __getitem__(self, user_id):
+        if user_id not in self:
+            raise KeyError(user_id)
+        return weekday_aggregates(connect(self.path), user_id)
+
+    def __iter__(self):
+        return (
+            row[0] for row in connect(self.path).execute(
+                'SELECT DISTINCT user_id FROM presence ORDER BY user_id'
+            )
+        )
+
+    def __len__(self):
+        return connect(self.path).execute(
+            'SELECT COUNT(DISTINCT user_id) FROM presence'
+        ).fetchone()[0]
+
+    def iteritems(self):
+        """
+        Yields aggregates of all users computed by single query.
+        """
+        rows = connect(self.path).execute((
+            'SELECT user_id, {0}, COUNT(*), SUM(end_time - start_time), '
+            'SUM(start_time), SUM(end_time) FROM presence '
+            'GROUP BY user_id, 2 ORDER BY user_id'
+        ).format(WEEKDAY))
+        user_id = result = None
+        for row in rows:
+            if row[0] != user_id:
+                if result is not None:
+                    yield user_id, result
+                user_id = row[0]
+                result = [[0, 0, 0, 0] for _ in range(7)]
+            result[row[1]] = list(row[2:])
+        if result is not None:
+            yield user_id, result
+
+    def items(self):
+        """
+        Returns aggregates of all users computed by single query.
+        """
+        return list(self.iteritems())
+
+    def values(self):
+        """
+        Returns aggregates of all users computed by single query.
+        """
+        return [result for _, result in self.iteritems()]
@@ -3,9 +3,75 @@
 Helper functions used in views.
 """
 
-from json import dumps
-from functools import wraps
-from flask import Response
+import zlib
+import json
+import bisect
+import hashlib
+import calendar
+from array import array
+from datetime import datetime, timedelta
+from functools import wraps, partial
+from flask import Response, request
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None  # pylint: disable-msg=C0103
+try:
+    import simplejson
+except ImportError:  # pragma: no cover
+    simplejson = None  # pylint: disable-msg=C0103
+
+from presence_analyzer.main import app
+from presence_analyzer import lru
+from presence_analyzer import metrics
+
+# available JSON encoders, fastest first
+JSON_BACKENDS = [('json', partial(json.dumps, separators=(',', ':')))]
+if simplejson is not None:
+    JSON_BACKENDS.insert(
+        0, ('simplejson', partial(simplejson.dumps, separators=(',', ':')))
+    )
+if ujson is not None:
+    JSON_BACKENDS.insert(0, ('ujson', ujson.dumps))
+
+
+@metrics.timed('serialize')
+def dumps(obj):
+    """
+    Serializes obj into compact JSON.
+
+    Encoder is chosen by JSON_BACKEND setting, fastest available one
+    is used by default.
+    """
+    name = app.config.get('JSON_BACKEND')
+    if name is None:
+        return JSON_BACKENDS[0][1](obj)
+    return dict(JSON_BACKENDS)[name](obj)
+
+
+class Serialized(str):
+    """
+    JSON document serialized in advance, passed by jsonify as is.
+
+    Keeps its compressed variants, see compress, and key of RESPONSE_CACHE
+    entry holding it, if any.
+    """
+    cache_key = None
+
+    def __init__(self, value=''):  # pylint: disable-msg=W0231,W0613
+        self.compressed = {}
+
+    def size(self):
+        """
+        Returns length of document together with its compressed variants.
+        """
+        return len(self) + sum(
+            len(compressed) for compressed in self.compressed.values()
+        )
+
+
+RESPONSE_CACHE = lru.LRUCache(sizeof=Serialized.size)
 
 
 def jsonify(function):
@@ -14,11 +80,154 @@ def jsonify(function):
     """
     @wraps(function)
     def inner(*args, **kwargs):
-        return Response(dumps(function(*args, **kwargs)),
-                        mimetype='application/json')
+        result = function(*args, **kwargs)
+        if not isinstance(result, Serialized):
+            result = Serialized(dumps(result))
+        return compress(result)
     return inner
 
 
+@metrics.timed('serialize')
+def compress(body):
+    """
+    Creates JSON response of serialized body, compressed with gzip
+    or deflate if client accepts it.
+
+    Only bodies of at least JSON_COMPRESS_MIN_SIZE bytes are compressed,
+    compression is disabled when the setting is not set. Compressed bodies
+    are kept with memoized body, so cache hits are not compressed again,
+    and count towards RESPONSE_CACHE size.
+    """
+    response = Response(body, mimetype='application/json')
+    min_size = app.config.get('JSON_COMPRESS_MIN_SIZE')
+    if min_size is None:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = _accepted_encoding(('gzip', 'deflate'))
+    if encoding is None or len(body) < min_size:
+        return response
+    level = app.config.get('JSON_COMPRESS_LEVEL', 6)
+    compressed = body.compressed.get((encoding, level))
+    if compressed is None:
+        if encoding == 'gzip':
+            compressor = zlib.compressobj(
+                level, zlib.DEFLATED, 16 + zlib.MAX_WBITS
+            )
+            compressed = compressor.compress(body) + compressor.flush()
+        else:
+            compressed = zlib.compress(body, level)
+        body.compressed[(encoding, level)] = compressed
+        if body.cache_key is not None:
+            RESPONSE_CACHE.recount(body.cache_key, body)
+    response.set_data(compressed)
+    response.content_encoding = encoding
+    return response
+
+
+def _accepted_encoding(names):
+    """
+    Returns first of given encodings with highest quality in Accept-Encoding
+    header, None when client refuses all of them.
+
+    Unlike best_match(), encodings refused with q=0 are never chosen, even
+    when "*" accepts any other.
+    """
+    qualities = dict(
+        (value.lower(), quality)
+        for value, quality in request.accept_encodings
+    )
+    result, best = None, 0
+    for name in names:
+        quality = qualities.get(name, qualities.get('*', 0))
+        if quality > best:
+            result, best = name, quality
+    return result
+
+
+def conditional(*versions, **options):
+    """
+    Handles HTTP conditional requests for views depending only on request
+    URL and data versions returned by given functions.
+
+    Each function returns (file versions, settings) of data served now,
+    like version() of loaders decorated with utils.cached. ETag and
+    Last-Modified are derived from them. Matching If-None-Match
+    or If-Modified-Since gets 304 response without calling the view.
+    Cache-Control header comes from CACHE_CONTROL setting
+    ({endpoint: value}), `cache_control` option or defaults to 'no-cache'.
+    """
+    default_cache_control = options.get('cache_control', 'no-cache')
+
+    def decorator(function):
+        @wraps(function)
+        def inner(*args, **kwargs):
+            served = [version() for version in versions]
+            etag = hashlib.md5(
+                repr((served, request.path, request.query_string))
+            ).hexdigest()
+            last_modified = datetime.utcfromtimestamp(int(max(
+                file_version[1]
+                for file_versions, _ in served
+                for file_version in file_versions
+            )))
+            cache_control = app.config.get('CACHE_CONTROL', {}).get(
+                request.endpoint, default_cache_control
+            )
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                not_modified = (
+                    request.if_modified_since is not None and
+                    request.if_modified_since >= last_modified
+                )
+
+            if not_modified:
+                response = Response(status=304)
+            else:
+                response = function(*args, **kwargs)
+            response.set_etag(etag, weak=True)
+            response.last_modified = last_modified
+            response.headers['Cache-Control'] = cache_control
+            return response
+        return inner
+    return decorator
+
+
+def memoize(*versions):
+    """
+    Caches serialized results of view depending only on its arguments,
+    request query and data versions returned by given functions, see
+    conditional.
+
+    Use below jsonify. Cache size is limited by RESPONSE_CACHE_MAX_ENTRIES
+    and RESPONSE_CACHE_MAX_BYTES settings.
+    """
+    def decorator(function):
+        @wraps(function)
+        def inner(*args, **kwargs):
+            RESPONSE_CACHE.resize(
+                app.config.get('RESPONSE_CACHE_MAX_ENTRIES', 1024),
+                app.config.get('RESPONSE_CACHE_MAX_BYTES', 16 << 20),
+            )
+            key = (
+                request.endpoint,
+                args,
+                tuple(sorted(kwargs.items())),
+                request.query_string,
+                tuple(version() for version in versions),
+            )
+            result = RESPONSE_CACHE.get(key)
+            if result is None:
+                result = Serialized(dumps(function(*args, **kwargs)))
+                result.cache_key = key
+                RESPONSE_CACHE.put(key, result)
+            return result
+        return inner
+    return decorator
+
+
+@metrics.timed('aggregate')
 def group_by_weekday(items):
     """
     Groups presence entries by weekday.
@@ -52,6 +261,7 @@ def mean(items):
     return float(sum(items)) / len(items) if len(items) > 0 else 0
 
 
+@metrics.timed('aggregate')
 def group_start_end_times_by_weekday(items):
     """
     Groups start and end times in sec. by weekday.
@@ -64,3 +274,224 @@ def group_start_end_times_by_weekday(items):
         result[date.weekday()]['start'].append(seconds_since_midnight(start))
         result[date.weekday()]['end'].append(seconds_since_midnight(end))
     return result
+
+
+def weekday_aggregates(items):
+    """
+    Sums presence entries by weekday.
+
+    Returns list of seven [count, total, start sum, end sum] lists in seconds,
+    Monday first.
+    """
+    result = [[0, 0, 0, 0] for _ in range(7)]
+    for date, start_end in items.iteritems():
+        add_to_aggregate(
+            result[date.weekday()], start_end['start'], start_end['end']
+        )
+    return result
+
+
+def add_to_aggregate(aggregate, start, end, sign=1):
+    """
+    Adds (or subtracts for negative sign) presence entry to weekday aggregate.
+    """
+    start = seconds_since_midnight(start)
+    end = seconds_since_midnight(end)
+    aggregate[0] += sign
+    aggregate[1] += sign * (end - start)
+    aggregate[2] += sign * start
+    aggregate[3] += sign * end
+
+
+def date_index(items):
+    """
+    Indexes presence entries by weekday for date range queries.
+
+    Returns list of seven (dates, totals, starts, ends) tuples, Monday
+    first. `dates` holds sorted date ordinals of given weekday, the other
+    arrays are prefix sums of presence, start and end seconds, so sum for
+    dates[i:j] is totals[j] - totals[i].
+    """
+    result = []
+    for weekday in range(7):
+        dates = array('i')
+        totals, starts, ends = (array('l', [0]) for _ in range(3))
+        for date in sorted(day for day in items if day.weekday() == weekday):
+            start = seconds_since_midnight(items[date]['start'])
+            end = seconds_since_midnight(items[date]['end'])
+            dates.append(date.toordinal())
+            totals.append(totals[-1] + end - start)
+            starts.append(starts[-1] + start)
+            ends.append(ends[-1] + end)
+        result.append((dates, totals, starts, ends))
+    return result
+
+
+@metrics.timed('aggregate')
+def range_aggregates(index, first=None, last=None):
+    """
+    Weekday aggregates of entries between first and last date (inclusive)
+    computed from date_index() structure in O(log n).
+    """
+    first = first.toordinal() if first is not None else 0
+    last = last.toordinal() if last is not None else datetime.max.toordinal()
+    result = []
+    for dates, totals, starts, ends in index:
+        low = bisect.bisect_left(dates, first)
+        high = max(bisect.bisect_right(dates, last), low)
+        result.append([
+            high - low,
+            totals[high] - totals[low],
+            starts[high] - starts[low],
+            ends[high] - ends[low],
+        ])
+    return result
+
+
+def timeline(changes, base=None):
+    """
+    Builds company-wide timeline of daily presence.
+
+    `changes` is iterable of (date ordinal, seconds, headcount) tuples added
+    on top of `base` timeline, if given. Returned structure:
+
+    timeline = {
+        'first': <ordinal of first day or None for empty timeline>,
+        'daily_totals': <presence seconds of each day>,
+        'daily_heads': <number of users present each day>,
+        'totals': <prefix sums of daily_totals>,
+        'heads': <prefix sums of daily_heads>,
+    }
+    """
+    changes = list(changes)
+    bounds = [change[0] for change in changes]
+    if base is not None and base['first'] is not None:
+        bounds += [
+            base['first'],
+            base['first'] + len(base['daily_totals']) - 1,
+        ]
+    if not bounds:
+        return {
+            'first': None,
+            'daily_totals': array('l'),
+            'daily_heads': array('l'),
+            'totals': array('l', [0]),
+            'heads': array('l', [0]),
+        }
+
+    first = min(bounds)
+    size = max(bounds) - first + 1
+    daily_totals = array('l', [0]) * size
+    daily_heads = array('l', [0]) * size
+    if base is not None and base['first'] is not None:
+        offset = base['first'] - first
+        daily_totals[offset:offset + len(base['daily_totals'])] = (
+            base['daily_totals']
+        )
+        daily_heads[offset:offset + len(base['daily_heads'])] = (
+            base['daily_heads']
+        )
+    for ordinal, seconds, heads in changes:
+        daily_totals[ordinal - first] += seconds
+        daily_heads[ordinal - first] += heads
+
+    totals, heads = array('l', [0]), array('l', [0])
+    for day_total, day_heads in zip(daily_totals, daily_heads):
+        totals.append(totals[-1] + day_total)
+        heads.append(heads[-1] + day_heads)
+    return {
+        'first': first,
+        'daily_totals': daily_totals,
+        'daily_heads': daily_heads,
+        'totals': totals,
+        'heads': heads,
+    }
+
+
+@metrics.timed('aggregate')
+def timeline_range(timeline, first, last):
+    """
+    Returns (presence seconds, headcount) between first and last date
+    (inclusive) from timeline prefix sums in constant time.
+
+    Headcount of ranges longer than a day counts user-days.
+    """
+    if timeline['first'] is None:
+        return 0, 0
+    size = len(timeline['totals']) - 1
+    low = min(max(first.toordinal() - timeline['first'], 0), size)
+    high = min(max(last.toordinal() - timeline['first'] + 1, 0), size)
+    if high <= low:
+        return 0, 0
+    return (
+        timeline['totals'][high] - timeline['totals'][low],
+        timeline['heads'][high] - timeline['heads'][low],
+    )
+
+
+def periods(first, last, period):
+    """
+    Splits dates between first and last (inclusive) into 'daily', 'weekly'
+    (starting on Monday) or 'monthly' periods. Yields (start, end) pairs
+    clipped to given dates.
+    """
+    start = first
+    while start <= last:
+        if period == 'daily':
+            end = start
+        elif period == 'weekly':
+            end = start + timedelta(days=6 - start.weekday())
+        elif period == 'monthly':
+            end = start.replace(
+                day=calendar.monthrange(start.year, start.month)[1]
+            )
+        else:
+            raise ValueError('Unknown period {0!r}'.format(period))
+        end = min(end, last)
+        yield start, end
+        start = end + timedelta(days=1)
+
+
+def ratio(total, count):
+    """
+    Divides total by count. Returns zero for zero count, same as mean().
+    """
+    return float(total) / count if count > 0 else 0
+
+
+@metrics.timed('aggregate')
+def mean_time_weekday(aggregates):
+    """
+    Mean presence time by weekday from weekday aggregates.
+    """
+    return [
+        (calendar.day_abbr[weekday], ratio(total, count))
+        for weekday, (count, total, _, _) in enumerate(aggregates)
+    ]
+
+
+@metrics.timed('aggregate')
+def presence_weekday(aggregates):
+    """
+    Total presence time by weekday from weekday aggregates.
+    """
+    result = [
+        (calendar.day_abbr[weekday], total)
+        for weekday, (_, total, _, _) in enumerate(aggregates)
+    ]
+    result.insert(0, ('Weekday', 'Presence (s)'))
+    return result
+
+
+@metrics.timed('aggregate')
+def presence_start_end(aggregates):
+    """
+    Mean arrival and departure time by weekday from weekday aggregates.
+    """
+    return [
+        (
+            calendar.day_abbr[weekday], ratio(starts, count),
+            ratio(ends, count)
+        )
+        for weekday, (count, _, starts, ends) in enumerate(aggregates)
+    ]
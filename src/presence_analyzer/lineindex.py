@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+Per-user index of line ranges in presence CSV file.
+
+Lets chart views read and parse lines of single user only. File layout
+(little endian):
+
+    header   magic, source CSV size and mtime, user count
+    users    one (user_id, first range, range count) entry per user,
+             sorted by user_id
+    ranges   one (offset, length) entry per run of consecutive lines
+             of the same user, in file order
+"""
+
+import os
+import mmap
+import struct
+import threading
+from array import array
+from collections import Mapping, OrderedDict
+
+from presence_analyzer import utils
+from presence_analyzer import helpers
+from presence_analyzer import snapshot
+
+MAGIC = 'PRESIDX1'
+HEADER = struct.Struct('<8sQdI')
+USER = snapshot.USER
+RANGE = struct.Struct('<QI')
+
+
+class LineIndexError(Exception):
+    """
+    Raised when index file is not valid.
+    """
+
+
+def _user_id(line):
+    """
+    Returns user id of CSV line, None for header and malformed lines.
+    """
+    user_id = line.split(',', 1)[0].strip()
+    if not user_id.isdigit():
+        return None
+    return int(user_id)
+
+
+def build(source, path):
+    """
+    Scans CSV file and writes index of its lines into path.
+
+    Runs of consecutive lines of the same user are stored as single range.
+    File is replaced atomically. Returns number of indexed users.
+    """
+    stat = os.stat(source)
+    ranges = {}
+    offset = 0
+    with open(source, 'rb') as csvfile:
+        for line in csvfile:
+            user_id = _user_id(line)
+            if user_id is not None:
+                offsets, lengths = ranges.setdefault(
+                    user_id, (array('L'), array('L'))
+                )
+                if offsets and offsets[-1] + lengths[-1] == offset:
+                    lengths[-1] += len(line)
+                else:
+                    offsets.append(offset)
+                    lengths.append(len(line))
+            offset += len(line)
+
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as output:
+        output.write(
+            HEADER.pack(MAGIC, stat.st_size, stat.st_mtime, len(ranges))
+        )
+        first = 0
+        for user_id in sorted(ranges):
+            count = len(ranges[user_id][0])
+            output.write(USER.pack(user_id, first, count))
+            first += count
+        for user_id in sorted(ranges):
+            for offset, length in zip(*ranges[user_id]):
+                output.write(RANGE.pack(offset, length))
+    os.rename(tmp_path, path)
+    return len(ranges)
+
+
+class LineIndex(object):
+    """
+    Read-only, memory-mapped index file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as index_file:
+            try:
+                self.buffer = mmap.mmap(
+                    index_file.fileno(), 0, access=mmap.ACCESS_READ
+                )
+            except (ValueError, mmap.error):
+                raise LineIndexError('Cannot map {0}'.format(path))
+        if len(self.buffer) < HEADER.size:
+            raise LineIndexError('Truncated index {0}'.format(path))
+
+        (magic, self.source_size, self.source_mtime,
+         self.user_count) = HEADER.unpack_from(self.buffer)
+        users_offset = HEADER.size
+        self.ranges_offset = users_offset + USER.size * self.user_count
+        if (magic != MAGIC or len(self.buffer) < self.ranges_offset or
+                (len(self.buffer) - self.ranges_offset) % RANGE.size):
+            raise LineIndexError('Invalid index {0}'.format(path))
+        self.users = dict(
+            (user_id, (first, count))
+            for user_id, first, count in (
+                USER.unpack_from(self.buffer, offset)
+                for offset in xrange(
+                    users_offset, self.ranges_offset, USER.size
+                )
+            )
+        )
+
+    def close(self):
+        """
+        Unmaps index file.
+        """
+        self.buffer.close()
+
+    def is_fresh(self, source):
+        """
+        Checks whether index was built from current source CSV file.
+        """
+        stat = os.stat(source)
+        return (stat.st_size, stat.st_mtime) == (
+            self.source_size, self.source_mtime
+        )
+
+    def ranges(self, user_id):
+        """
+        Returns (offset, length) line ranges of given user.
+        """
+        first, count = self.users.get(user_id, (0, 0))
+        offset = self.ranges_offset + first * RANGE.size
+        return [
+            RANGE.unpack_from(self.buffer, offset + i * RANGE.size)
+            for i in xrange(count)
+        ]
+
+    def read_lines(self, source, user_id):
+        """
+        Reads CSV lines of given user from source file.
+        """
+        lines = []
+        with open(source, 'rb') as csvfile:
+            for offset, length in self.ranges(user_id):
+                csvfile.seek(offset)
+                lines.extend(csvfile.read(length).splitlines(True))
+        return lines
+
+
+def open_index(source, path):
+    """
+    Opens index of source CSV file, rebuilding it when missing or stale.
+    """
+    if os.path.exists(path):
+        try:
+            index = LineIndex(path)
+        except LineIndexError:
+            pass
+        else:
+            if index.is_fresh(source):
+                return index
+            index.close()
+    build(source, path)
+    return LineIndex(path)
+
+
+class Aggregates(Mapping):
+    """
+    Read-only {user_id: weekday aggregates} mapping parsing lines of
+    requested user only, usable in place of utils.build_aggregates() result.
+
+    Parsed lines of `max_users` most recently requested users are kept.
+    """
+
+    def __init__(self, index, source, max_users=256):
+        self.index = index
+        self.source = source
+        self.max_users = max_users
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, user_id):
+        return user_id in self.index.users
+
+    def __getitem__(self, user_id):
+        if user_id not in self.index.users:
+            raise KeyError(user_id)
+        return self._user(user_id)[2]
+
+    def __iter__(self):
+        return iter(sorted(self.index.users))
+
+    def __len__(self):
+        return len(self.index.users)
+
+    def _read(self, user_id):
+        """
+        Reads and parses CSV lines of given user.
+        """
+        lines = self.index.read_lines(self.source, user_id)
+        return utils.read_data(lines).get(user_id, {})
+
+    def _user(self, user_id):
+        """
+        Returns (presence entries, date index, weekday aggregates)
+        of given user.
+        """
+        with self._lock:
+            entry = self._recent.pop(user_id, None)
+            if entry is not None:
+                self._recent[user_id] = entry
+                return entry
+        items = self._read(user_id)
+        entry = (
+            items,
+            helpers.date_index(items),
+            helpers.weekday_aggregates(items),
+        )
+        with self._lock:
+            self._recent[user_id] = entry
+            while len(self._recent) > self.max_users:
+                self._recent.popitem(last=False)
+        return entry
+
+    def user_data(self, user_id):
+        """
+        Returns presence entries of given user, like utils.get_data()[user].
+        """
+        return self._user(user_id)[0]
+
+    def date_index(self, user_id):
+        """
+        Returns helpers.date_index() of given user.
+        """
+        return self._user(user_id)[1]
+
+    def timeline(self):
+        """
+        Builds company-wide timeline of daily presence, see helpers.timeline,
+        reading lines of one user at a time.
+        """
+        daily = {}
+        for user_id in self.index.users:
+            for day, start_end in self._read(user_id).iteritems():
+                totals = daily.setdefault(day.toordinal(), [0, 0])
+                totals[0] += helpers.interval(
+                    start_end['start'], start_end['end']
+                )
+                totals[1] += 1
+        return helpers.timeline(
+            (day, total, heads) for day, (total, heads) in daily.iteritems()
+        )
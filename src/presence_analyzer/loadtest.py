@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Closed-loop HTTP load generator replaying frontend traffic.
+
+Each simulated visitor opens one of the chart pages, loads users listing
+and then shows charts of randomly selected users, like static/js/app.js
+does, immediately starting next visit when done.
+
+Usage: bin/python-console -m presence_analyzer.loadtest
+       [--url http://127.0.0.1:5000] [--concurrency 10] [--duration 30]
+"""
+import sys
+import json
+import zlib
+import random
+import socket
+import urlparse
+import httplib
+import argparse
+import threading
+from timeit import default_timer as timer
+
+from presence_analyzer.percentiles import percentile
+
+# chart pages and API endpoint each of them calls for selected user
+PAGES = (
+    ('/', '/api/v1/presence_weekday/{0}'),
+    ('/mean_time', '/api/v1/mean_time_weekday/{0}'),
+    ('/start_end', '/api/v1/presence_start_end/{0}'),
+)
+USERS_URL = '/api/v1/users'
+
+
+class Client(object):
+    """
+    Keep-alive HTTP connection of single simulated visitor.
+    """
+
+    def __init__(self, url, timeout=10):
+        parts = urlparse.urlsplit(url)
+        self.connection = httplib.HTTPConnection(
+            parts.hostname, parts.port or 80, timeout=timeout
+        )
+
+    def get(self, path):
+        """
+        Requests path, returns (status, body, seconds).
+
+        Status is None when request failed on connection level.
+        """
+        started = timer()
+        try:
+            self.connection.request('GET', path, headers={
+                'Accept-Encoding': 'gzip, deflate',
+            })
+            response = self.connection.getresponse()
+            body = response.read()
+        except (httplib.HTTPException, socket.error):
+            self.connection.close()
+            return None, '', timer() - started
+        elapsed = timer() - started
+        encoding = response.getheader('Content-Encoding')
+        if encoding == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            body = zlib.decompress(body)
+        return response.status, body, elapsed
+
+    def close(self):
+        """
+        Closes connection.
+        """
+        self.connection.close()
+
+
+class LoadTest(object):
+    """
+    Runs `concurrency` visitors against server at `url` for `duration`
+    seconds, each visit showing `charts` charts.
+    """
+
+    def __init__(self, url, concurrency=10, duration=30.0, charts=3,
+                 seed=0):
+        self.url = url
+        self.concurrency = concurrency
+        self.duration = duration
+        self.charts = charts
+        self.seed = seed
+        self.deadline = None
+        self.samples = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def record(self, label, status, seconds):
+        """
+        Stores latency of request, failed ones are counted as errors.
+        """
+        with self.lock:
+            if status is None or status >= 400:
+                self.errors[label] = self.errors.get(label, 0) + 1
+            else:
+                self.samples.setdefault(label, []).append(seconds)
+
+    def request(self, client, label, path):
+        """
+        Requests path unless test is over. Returns body or None.
+        """
+        if timer() >= self.deadline:
+            return None
+        status, body, seconds = client.get(path)
+        self.record(label, status, seconds)
+        return body if status == 200 else None
+
+    def visit(self, client, rand):
+        """
+        Replays single visit of chart page.
+        """
+        page, chart = rand.choice(PAGES)
+        self.request(client, page, page)
+        body = self.request(client, USERS_URL, USERS_URL)
+        if not body:
+            return
+        users = [user['user_id'] for user in json.loads(body)]
+        for _ in xrange(self.charts if users else 0):
+            self.request(client, chart.format('<user_id>'),
+                         chart.format(rand.choice(users)))
+
+    def visitor(self, number):
+        """
+        Runs visits one after another until deadline.
+        """
+        rand = random.Random((self.seed, number))
+        client = Client(self.url)
+        try:
+            while timer() < self.deadline:
+                self.visit(client, rand)
+        finally:
+            client.close()
+
+    def run(self):
+        """
+        Runs load test, returns its results.
+        """
+        started = timer()
+        self.deadline = started + self.duration
+        threads = [
+            threading.Thread(target=self.visitor, args=(number,))
+            for number in xrange(self.concurrency)
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.results(timer() - started)
+
+    def results(self, seconds):
+        """
+        Summarizes throughput and latency percentiles, in total and
+        per endpoint.
+        """
+        def summary(samples, errors):
+            result = {
+                'requests': len(samples) + errors,
+                'errors': errors,
+                'throughput': len(samples) / seconds,
+            }
+            if samples:
+                result.update(
+                    (name, percentile(samples, fraction))
+                    for name, fraction in (('p50', 0.5), ('p95', 0.95),
+                                           ('p99', 0.99))
+                )
+            return result
+
+        labels = set(self.samples) | set(self.errors)
+        endpoints = dict(
+            (label, summary(self.samples.get(label, []),
+                            self.errors.get(label, 0)))
+            for label in labels
+        )
+        total = summary(
+            [sample for samples in self.samples.values()
+             for sample in samples],
+            sum(self.errors.values())
+        )
+        total.update(seconds=seconds, concurrency=self.concurrency)
+        return {'total': total, 'endpoints': endpoints}
+
+
+def report(results):
+    """
+    Prints load test results as a table, latencies in milliseconds.
+    """
+    rows = [('total', results['total'])]
+    rows += sorted(results['endpoints'].items())
+    width = max(len(label) for label, _ in rows)
+    print '{0:<{w}} {1:>9} {2:>7} {3:>9} {4:>9} {5:>9} {6:>9}'.format(
+        'endpoint', 'requests', 'errors', 'req/s', 'p50', 'p95', 'p99',
+        w=width
+    )
+    for label, result in rows:
+        print '{0:<{w}} {1:>9} {2:>7} {3:>9.1f} {4:>9} {5:>9} {6:>9}'.format(
+            label, result['requests'], result['errors'],
+            result['throughput'],
+            *['{0:.1f}'.format(result[name] * 1000) if name in result else ''
+              for name in ('p50', 'p95', 'p99')],
+            w=width
+        )
+
+
+def main(argv=None):
+    """
+    Runs load test against running server.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='simultaneous visitors')
+    parser.add_argument('--duration', type=float, default=30.0,
+                        help='seconds')
+    parser.add_argument('--charts', type=int, default=3,
+                        help='charts shown per visit')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write results as JSON')
+    args = parser.parse_args(argv)
+    results = LoadTest(args.url, args.concurrency, args.duration,
+                       args.charts, args.seed).run()
+    report(results)
+    if args.output:
+        with open(args.output, 'wb') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
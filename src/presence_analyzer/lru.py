@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Thread-safe LRU cache bounded by number of entries and total size.
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Least recently used cache of string values.
+
+    Oldest entries are evicted when either `max_entries` or `max_bytes`
+    (sum of value sizes, returned by `sizeof`) would be exceeded.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=16 << 20, sizeof=len):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, key, default=None):
+        """
+        Returns cached value and marks it as recently used.
+        """
+        with self._lock:
+            try:
+                value, size = self._entries.pop(key)
+            except KeyError:
+                self._stats['misses'] += 1
+                return default
+            self._entries[key] = value, size
+            self._stats['hits'] += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Stores value, evicting least recently used entries if needed.
+
+        Values larger than `max_bytes` are not stored at all.
+        """
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = value, size
+            self._bytes += size
+            self._evict()
+
+    def recount(self, key, value):
+        """
+        Updates size of value still cached under key after it changed,
+        evicting entries if needed.
+        """
+        size = self.sizeof(value)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] is not value:
+                return
+            self._bytes += size - entry[1]
+            self._entries[key] = value, size
+            if size > self.max_bytes:
+                self._bytes -= self._entries.pop(key)[1]
+            self._evict()
+
+    def resize(self, max_entries, max_bytes):
+        """
+        Changes limits, evicting entries over them.
+        """
+        with self._lock:
+            if (max_entries, max_bytes) == (self.max_entries, self.max_bytes):
+                return
+            self.max_entries = max_entries
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        """
+        Drops least recently used entries until limits are met.
+        """
+        while self._entries and (len(self._entries) > self.max_entries or
+                                 self._bytes > self.max_bytes):
+            _, (_, size) = self._entries.popitem(last=False)
+            self._bytes -= size
+            self._stats['evictions'] += 1
+
+    def clear(self):
+        """
+        Drops all entries and resets counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            for stat in self._stats:
+                self._stats[stat] = 0
+
+    def stats(self):
+        """
+        Returns counters together with current size of the cache.
+        """
+        with self._lock:
+            return dict(
+                self._stats,
+                entries=len(self._entries),
+                bytes=self._bytes,
+                max_entries=self.max_entries,
+                max_bytes=self.max_bytes,
+            )
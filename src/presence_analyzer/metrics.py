@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Request latency metrics in Prometheus text format.
+
+Every request is timed by endpoint, including ones failed with unhandled
+exception. Functions decorated with `timed` add their duration to a phase
+of current request ('load', 'aggregate', 'serialize'), nested calls count
+towards the outermost phase only.
+"""
+
+import bisect
+import threading
+from functools import wraps
+from timeit import default_timer as timer
+
+from flask import request
+
+from presence_analyzer.main import app
+
+# upper bounds of histogram buckets in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class Histogram(object):
+    """
+    Counts of observed values falling into BUCKETS.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # last one counts values above all buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        """
+        Adds value to its bucket.
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def cumulative(self):
+        """
+        Returns (upper bound, count of values not above it) pairs.
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+REQUESTS = {}
+LATENCY = {}
+PHASES = {}
+
+
+def timed(phase):
+    """
+    Adds duration of decorated function to given phase of current request.
+    """
+    def decorator(function):
+        @wraps(function)
+        def inner(*args, **kwargs):
+            phases = getattr(_local, 'phases', None)
+            if phases is None or _local.depth:
+                return function(*args, **kwargs)
+            _local.depth += 1
+            started = timer()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _local.depth -= 1
+                phases[phase] = phases.get(phase, 0) + timer() - started
+        return inner
+    return decorator
+
+
+@app.before_request
+def start_request():
+    """
+    Starts timing of request.
+    """
+    _local.started = timer()
+    _local.phases = {}
+    _local.depth = 0
+
+
+@app.after_request
+def finish_request(response):
+    """
+    Records latency of request and of its phases.
+    """
+    _record(response.status_code)
+    return response
+
+
+@app.teardown_request
+def teardown_request(exception):  # pylint: disable-msg=W0613
+    """
+    Records request failed with unhandled exception, after_request
+    functions are not called for it.
+    """
+    _record(500)
+
+
+def _record(status):
+    """
+    Records latency of current request, unless it was already recorded.
+    """
+    started = getattr(_local, 'started', None)
+    if started is None:
+        return
+    elapsed = timer() - started
+    phases = _local.phases
+    _local.started = _local.phases = None
+    endpoint = request.endpoint or 'unknown'
+    with _lock:
+        key = (endpoint, request.method, str(status))
+        REQUESTS[key] = REQUESTS.get(key, 0) + 1
+        LATENCY.setdefault(endpoint, Histogram()).observe(elapsed)
+        for phase, seconds in phases.iteritems():
+            PHASES.setdefault((endpoint, phase), Histogram()).observe(seconds)
+
+
+def clear():
+    """
+    Drops all recorded metrics.
+    """
+    with _lock:
+        REQUESTS.clear()
+        LATENCY.clear()
+        PHASES.clear()
+
+
+def _labels(**labels):
+    """
+    Formats Prometheus labels.
+    """
+    return ','.join(
+        '{0}="{1}"'.format(
+            name,
+            str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n')
+        )
+        for name, value in sorted(labels.items())
+    )
+
+
+def _histogram(lines, name, histogram, **labels):
+    """
+    Appends Prometheus samples of histogram.
+    """
+    for bound, count in histogram.cumulative():
+        lines.append('{0}_bucket{{{1}}} {2}'.format(
+            name, _labels(le=bound, **labels), count
+        ))
+    lines.append('{0}_sum{{{1}}} {2!r}'.format(
+        name, _labels(**labels), histogram.sum
+    ))
+    lines.append('{0}_count{{{1}}} {2}'.format(
+        name, _labels(**labels), sum(histogram.counts)
+    ))
+
+
+def render():
+    """
+    Returns all metrics in Prometheus text exposition format.
+    """
+    lines = [
+        '# HELP presence_requests_total Requests by endpoint and status.',
+        '# TYPE presence_requests_total counter',
+    ]
+    with _lock:
+        for (endpoint, method, status), count in sorted(REQUESTS.items()):
+            lines.append('presence_requests_total{{{0}}} {1}'.format(
+                _labels(endpoint=endpoint, method=method, status=status),
+                count
+            ))
+        lines += [
+            '# HELP presence_request_duration_seconds '
+            'Request latency by endpoint.',
+            '# TYPE presence_request_duration_seconds histogram',
+        ]
+        for endpoint, histogram in sorted(LATENCY.items()):
+            _histogram(lines, 'presence_request_duration_seconds',
+                       histogram, endpoint=endpoint)
+        lines += [
+            '# HELP presence_request_phase_seconds '
+            'Time spent in data load, aggregation and serialization.',
+            '# TYPE presence_request_phase_seconds histogram',
+        ]
+        for (endpoint, phase), histogram in sorted(PHASES.items()):
+            _histogram(lines, 'presence_request_phase_seconds',
+                       histogram, endpoint=endpoint, phase=phase)
+    return '\n'.join(lines) + '\n'
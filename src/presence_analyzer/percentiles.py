@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+"""
+Percentiles of timing samples, shared by benchmarks and load generator.
+
+Has no dependencies on the web app.
+"""
+import math
+
+
+def percentile(samples, fraction):
+    """
+    Returns nearest-rank percentile of samples, fraction between 0 and 1.
+    """
+    ordered = sorted(samples)
+    return ordered[max(int(math.ceil(fraction * len(ordered))) - 1, 0)]
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+On-demand request profiling, enabled by PROFILING setting.
+
+ - request with PROFILE_HEADER (X-Profile by default) header is profiled,
+   stats are saved into PROFILE_DIR and named in the same response header,
+ - /debug/profile/<path> runs /<path> under profiler and returns stats
+   as text instead of the response,
+ - with PROFILE_SAMPLE_RATE set to N, every N-th request is profiled and
+   its stats are added to PROFILE_DIR/sampled-<pid>.prof.
+"""
+
+import os
+import time
+import pstats
+import cProfile
+import itertools
+import threading
+from StringIO import StringIO
+
+from presence_analyzer.main import app
+
+DEBUG_PREFIX = '/debug/profile'
+
+
+class ProfilerMiddleware(object):
+    """
+    WSGI middleware profiling requests selected by settings.
+    """
+
+    def __init__(self, wsgi_app, config):
+        self.wsgi_app = wsgi_app
+        self.config = config
+        self.counter = itertools.count(1)
+        self.sampled = None
+        self.lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        if not self.config.get('PROFILING'):
+            return self.wsgi_app(environ, start_response)
+
+        path = environ.get('PATH_INFO', '')
+        header = 'HTTP_' + self.config.get(
+            'PROFILE_HEADER', 'X-Profile'
+        ).upper().replace('-', '_')
+        rate = self.config.get('PROFILE_SAMPLE_RATE')
+        if path.startswith(DEBUG_PREFIX + '/'):
+            environ['PATH_INFO'] = path[len(DEBUG_PREFIX):]
+            return self.profile_to_text(environ, start_response)
+        if header in environ:
+            return self.profile_to_file(environ, start_response)
+        if rate and next(self.counter) % rate == 0:
+            return self.profile_sampled(environ, start_response)
+        return self.wsgi_app(environ, start_response)
+
+    def run(self, environ):
+        """
+        Calls application under profiler.
+
+        Returns (profiler, status, headers, body).
+        """
+        response = []
+
+        def start_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+            return lambda data: None
+
+        def call():
+            result = self.wsgi_app(environ, start_response)
+            try:
+                return ''.join(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+
+        profiler = cProfile.Profile()
+        body = profiler.runcall(call)
+        status, headers = response
+        return profiler, status, headers, body
+
+    def profile_to_text(self, environ, start_response):
+        """
+        Responds with stats of profiled request.
+        """
+        profiler, status, _, _ = self.run(environ)
+        output = StringIO()
+        output.write('{0} {1}\n'.format(environ['PATH_INFO'], status))
+        stats = pstats.Stats(profiler, stream=output)
+        stats.sort_stats(self.config.get('PROFILE_SORT', 'cumulative'))
+        stats.print_stats(self.config.get('PROFILE_LIMIT', 40))
+        body = output.getvalue()
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; charset=utf-8'),
+            ('Content-Length', str(len(body))),
+        ])
+        return [body]
+
+    def profile_to_file(self, environ, start_response):
+        """
+        Saves stats of profiled request, returns its response.
+        """
+        profiler, status, headers, body = self.run(environ)
+        name = '{0}-{1:.6f}.prof'.format(
+            environ.get('PATH_INFO', '').strip('/').replace('/', '.') or
+            'index',
+            time.time(),
+        )
+        profiler.dump_stats(os.path.join(self.directory(), name))
+        header = self.config.get('PROFILE_HEADER', 'X-Profile')
+        start_response(status, headers + [(header, name)])
+        return [body]
+
+    def profile_sampled(self, environ, start_response):
+        """
+        Adds stats of profiled request to the ones aggregated on disk.
+        """
+        profiler, status, headers, body = self.run(environ)
+        path = os.path.join(
+            self.directory(), 'sampled-{0}.prof'.format(os.getpid())
+        )
+        with self.lock:
+            if self.sampled is None:
+                self.sampled = pstats.Stats(profiler)
+            else:
+                self.sampled.add(profiler)
+            self.sampled.dump_stats(path)
+        start_response(status, headers)
+        return [body]
+
+    def directory(self):
+        """
+        Returns PROFILE_DIR, creating it when missing.
+        """
+        directory = self.config.get('PROFILE_DIR', 'profile')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        return directory
+
+
+app.wsgi_app = ProfilerMiddleware(app.wsgi_app, app.config)
@@ -4,10 +4,6 @@ import os
 import sys
 from functools import partial
 
-import paste.script.command
-import werkzeug.script
-import requests
-
 import logging
 log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
 
@@ -28,10 +24,21 @@ del _buildout_path
 
 
 # bin/paster serve parts/etc/deploy.ini
-def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
+def make_app(global_conf={}, config=DEPLOY_CFG, debug=False,
+             background=True):
     from presence_analyzer import app
     app.config.from_pyfile(abspath(config))
     app.debug = debug
+    interval = app.config.get('DATA_REFRESH_INTERVAL')
+    if background:
+        from presence_analyzer import utils
+        # parsing processes are forked before any thread starts
+        utils.start_workers(app.config.get('DATA_CSV_WORKERS', 1))
+        if app.config.get('PREWARM'):
+            # refresher starts once warm up has loaded the data
+            utils.start_warm_up(interval)
+        elif interval:
+            utils.start_refresher(interval)
     return app
 
 
@@ -79,11 +86,13 @@ def _serve(action, debug=False, dry_run=False):
         ]
     sys.argv = argv[:2] + [abspath(config)] + argv[3:]
     # Run the 'paster' command
+    import paste.script.command
     paste.script.command.run()
 
 
 # bin/flask-ctl ...
 def run():
+    import werkzeug.script
     action_shell = werkzeug.script.make_shell(make_shell, make_shell.__doc__)
 
     # bin/flask-ctl serve [fg|start|stop|restart|status|initdb]
@@ -114,6 +123,80 @@ def run():
         """Stop the application."""
         _serve('stop', dry_run=dry_run)
 
+    # bin/flask-ctl snapshot
+    def action_snapshot(output=('o', '')):
+        """Build binary snapshot of presence data.
+
+        Options:
+         - '--output' snapshot path, DATA_SNAPSHOT setting by default
+        """
+        from presence_analyzer import utils
+        app = make_app(background=False)
+        path = output or app.config.get('DATA_SNAPSHOT')
+        if not path:
+            print 'DATA_SNAPSHOT is not configured, use --output'
+            return
+        records = utils.build_snapshot(path)
+        print 'Wrote {0} records to {1}'.format(records, path)
+
+    # bin/flask-ctl import
+    def action_import(full=False):
+        """Import new presence data and users into SQLite database.
+
+        Only rows appended to DATA_CSV since previous import are imported.
+
+        Options:
+         - '--full' import all rows again
+        """
+        from presence_analyzer import database
+        app = make_app(background=False)
+        path = app.config['DATABASE']
+        connection = database.connect(path)
+        rows = database.import_csv(connection, app.config['DATA_CSV'], full)
+        users = database.import_users(connection, app.config['USERS_XML'])
+        print 'Imported {0} rows and {1} users into {2}'.format(
+            rows, users, path
+        )
+
+    # bin/flask-ctl benchmark
+    def action_benchmark(baseline=('b', ''), threshold=10.0, update=False,
+                         scale=0, years=0, repeat=0):
+        """Compare benchmark results with stored baseline.
+
+        Exits with status 1 when any benchmark got slower than baseline.
+
+        Options:
+         - '--baseline' JSON file, var/benchmarks.json by default
+         - '--threshold' percent of slowdown failing comparison
+         - '--update' store new baseline instead of comparing
+         - '--scale', '--years', '--repeat' override baseline options
+        """
+        from presence_analyzer import benchmarks
+        sys.exit(benchmarks.check(
+            baseline or abspath('var', 'benchmarks.json'),
+            threshold, update,
+            scale=scale or None, years=years or None, repeat=repeat or None,
+        ))
+
+    # bin/flask-ctl loadtest
+    def action_loadtest(url=('u', 'http://127.0.0.1:5000'),
+                        concurrency=('c', 10), duration=('d', 30.0),
+                        charts=3, seed=0):
+        """Replay frontend traffic against running server.
+
+        Prints throughput and p50/p95/p99 latency of simulated visitors.
+
+        Options:
+         - '--url' server address
+         - '--concurrency' simultaneous visitors
+         - '--duration' seconds of test
+         - '--charts' charts shown per visit
+        """
+        from presence_analyzer import loadtest
+        loadtest.report(loadtest.LoadTest(
+            url, concurrency, duration, charts, seed
+        ).run())
+
     werkzeug.script.run()
 
 
@@ -121,7 +204,8 @@ def get_users_xml_data():
     """
     Get users.xml files and save if on disk.
     """
-    app = make_app()
+    import requests
+    app = make_app(background=False)
     users_data_url = app.config['USERS_XML_URL']
     r = requests.get(users_data_url, timeout=0.5)
 
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Binary snapshot of presence data for fast, memory-mapped loading.
+
+File layout (little endian):
+
+    header   magic, source CSV size, mtime and md5, user and record counts
+    users    one (user_id, first record, record count) entry per user
+    records  one (user_id, date ordinal, start, end) entry per presence row,
+             sorted by user and date; start and end in seconds since midnight
+"""
+
+import os
+import mmap
+import struct
+import hashlib
+from array import array
+from datetime import date, time
+
+from presence_analyzer import columnar
+
+MAGIC = 'PRESNAP1'
+HEADER = struct.Struct('<8sQd16sII')
+USER = struct.Struct('<iII')
+RECORD = struct.Struct('<iiii')
+
+
+class SnapshotError(Exception):
+    """
+    Raised when snapshot file is not valid.
+    """
+
+
+def checksum(path):
+    """
+    Returns md5 digest of given file.
+    """
+    digest = hashlib.md5()
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(1 << 20), ''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def source_info(path):
+    """
+    Returns (size, mtime, checksum) of source CSV file.
+    """
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime, checksum(path)
+
+
+def write(path, data, info):
+    """
+    Writes utils.get_data() structure into snapshot file.
+
+    `info` describes the CSV file data comes from, see `source_info`.
+    File is replaced atomically. Returns number of written records.
+    """
+    size, mtime, digest = info
+    users = sorted(data)
+    records = sum(len(data[user_id]) for user_id in users)
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as output:
+        output.write(
+            HEADER.pack(MAGIC, size, mtime, digest, len(users), records)
+        )
+        first = 0
+        for user_id in users:
+            output.write(USER.pack(user_id, first, len(data[user_id])))
+            first += len(data[user_id])
+        for user_id in users:
+            items = data[user_id]
+            for day in sorted(items):
+                output.write(RECORD.pack(
+                    user_id,
+                    day.toordinal(),
+                    columnar.seconds(items[day]['start']),
+                    columnar.seconds(items[day]['end']),
+                ))
+    os.rename(tmp_path, path)
+    return records
+
+
+class Snapshot(object):
+    """
+    Read-only, memory-mapped snapshot file.
+
+    Pages are shared through the page cache by all processes mapping
+    the same file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as snapshot_file:
+            try:
+                self.buffer = mmap.mmap(
+                    snapshot_file.fileno(), 0, access=mmap.ACCESS_READ
+                )
+            except (ValueError, mmap.error):
+                raise SnapshotError('Cannot map {0}'.format(path))
+        if len(self.buffer) < HEADER.size:
+            raise SnapshotError('Truncated snapshot {0}'.format(path))
+
+        (magic, self.source_size, self.source_mtime, self.source_checksum,
+         self.user_count, self.record_count) = HEADER.unpack_from(self.buffer)
+        self.users_offset = HEADER.size
+        self.records_offset = self.users_offset + USER.size * self.user_count
+        expected = self.records_offset + RECORD.size * self.record_count
+        if magic != MAGIC or len(self.buffer) != expected:
+            raise SnapshotError('Invalid snapshot {0}'.format(path))
+
+    def close(self):
+        """
+        Unmaps snapshot file.
+        """
+        self.buffer.close()
+
+    def is_fresh(self, source):
+        """
+        Checks whether snapshot was built from current source CSV file.
+
+        Checksum is computed only when size matches but mtime differs.
+        """
+        stat = os.stat(source)
+        if stat.st_size != self.source_size:
+            return False
+        if stat.st_mtime == self.source_mtime:
+            return True
+        return checksum(source) == self.source_checksum
+
+    def users(self):
+        """
+        Returns {user_id: (first record, record count)} table.
+        """
+        offsets = xrange(
+            self.users_offset, self.records_offset, USER.size
+        )
+        return {
+            user_id: (first, count)
+            for user_id, first, count in (
+                USER.unpack_from(self.buffer, offset) for offset in offsets
+            )
+        }
+
+    def user_records(self, user_id):
+        """
+        Returns (user_id, date ordinal, start, end) records of given user.
+        """
+        first, count = self.users().get(user_id, (0, 0))
+        offset = self.records_offset + first * RECORD.size
+        return [
+            RECORD.unpack_from(self.buffer, offset + i * RECORD.size)
+            for i in xrange(count)
+        ]
+
+    def to_data(self):
+        """
+        Builds utils.get_data() structure from snapshot records.
+
+        Records are read as native ints, little endian platforms only.
+        """
+        values = array('i')
+        values.fromstring(
+            self.buffer[self.records_offset:
+                        self.records_offset + RECORD.size * self.record_count]
+        )
+        data = {}
+        for i in xrange(0, len(values), 4):
+            user_data = data.setdefault(values[i], {})
+            start = values[i + 2]
+            end = values[i + 3]
+            user_data[date.fromordinal(values[i + 1])] = {
+                'start': time(start // 3600, start // 60 % 60, start % 60),
+                'end': time(end // 3600, end // 60 % 60, end % 60),
+            }
+        return data
+
+    def to_columns(self):
+        """
+        Builds columnar store viewing snapshot memory without copying.
+        """
+        numpy = columnar.load_numpy()
+        records = numpy.frombuffer(
+            self.buffer,
+            dtype=[('user_id', '<i4'), ('day', '<i4'),
+                   ('start', '<i4'), ('end', '<i4')],
+            count=self.record_count,
+            offset=self.records_offset,
+        )
+        users = numpy.frombuffer(
+            self.buffer,
+            dtype=[('user_id', '<i4'), ('first', '<u4'), ('count', '<u4')],
+            count=self.user_count,
+            offset=self.users_offset,
+        )
+        return columnar.ColumnarStore.from_sorted(
+            records['user_id'], records['day'],
+            records['start'], records['end'],
+            users['user_id'],
+            numpy.append(users['first'], self.record_count),
+        )
@@ -3,14 +3,26 @@
 Presence analyzer unit tests.
 """
 import os
+import zlib
 import json
+import time
+import pstats
+import itertools
+import shutil
+import calendar
+import tempfile
 import datetime
 import unittest
+import threading
 import mock
 
 from StringIO import StringIO
+from wsgiref import simple_server
 
-from presence_analyzer import main, utils, helpers
+from presence_analyzer import (
+    main, utils, helpers, columnar, snapshot, lru, benchmarks, metrics,
+    loadtest, database, lineindex, percentiles
+)
 
 TEST_DATA_CSV = os.path.join(
     os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'test_data.csv'
@@ -20,6 +32,14 @@ TEST_USERS_XML = os.path.join(
 )
 
 
+class QuietHandler(simple_server.WSGIRequestHandler):
+    """
+    Request handler of test server not logging requests.
+    """
+    def log_message(self, *args):
+        pass
+
+
 # pylint: disable=E1103
 class PresenceAnalyzerViewsTestCase(unittest.TestCase):
     """
@@ -30,7 +50,14 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         """
         Before each test, set up a environment.
         """
-        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update(
+            {
+                'DATA_CSV': TEST_DATA_CSV,
+                'USERS_XML': TEST_USERS_XML,
+            }
+        )
+        utils.clear_cache()
+        helpers.RESPONSE_CACHE.clear()
         self.client = main.app.test_client()
 
     def test_mainpage(self):
@@ -54,24 +81,27 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         resp = self.client.get('/start_end')
         self.assertEqual(resp.status_code, 200)
 
-    @mock.patch("presence_analyzer.views.utils")
-    def test_api_users_valid_user(self, data_mock):
+    @mock.patch("presence_analyzer.utils.get_user_data")
+    @mock.patch("presence_analyzer.utils.get_aggregates")
+    def test_api_users_valid_user(self, aggregates_mock, user_data_mock):
         """
         Test users listing.
         """
-        data_mock.get_data.return_value = {
-            10: {
-                datetime.date(2013, 10, 1): {
-                    'start': datetime.time(9, 0, 0),
-                    'end': datetime.time(17, 30, 0),
-                },
-                datetime.date(2013, 10, 2): {
-                    'start': datetime.time(8, 30, 0),
-                    'end': datetime.time(16, 45, 0),
-                },
+        aggregates_mock.return_value = utils.build_aggregates(
+            {
+                10: {
+                    datetime.date(2013, 10, 1): {
+                        'start': datetime.time(9, 0, 0),
+                        'end': datetime.time(17, 30, 0),
+                    },
+                    datetime.date(2013, 10, 2): {
+                        'start': datetime.time(8, 30, 0),
+                        'end': datetime.time(16, 45, 0),
+                    },
+                }
             }
-        }
-        data_mock.get_user_data.return_value = {
+        )
+        user_data_mock.return_value = {
             10: {
                 'avatar': 'http:///api/images/users/170',
                 'name': 'Agata Juszczak',
@@ -92,24 +122,27 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
             }
         )
 
-    @mock.patch("presence_analyzer.views.utils")
-    def test_api_users_invalid_user(self, data_mock):
+    @mock.patch("presence_analyzer.utils.get_user_data")
+    @mock.patch("presence_analyzer.utils.get_aggregates")
+    def test_api_users_invalid_user(self, aggregates_mock, user_data_mock):
         """
         Test users listing.
         """
-        data_mock.get_data.return_value = {
-            10: {
-                datetime.date(2013, 10, 1): {
-                    'start': datetime.time(9, 0, 0),
-                    'end': datetime.time(17, 30, 0),
-                },
-                datetime.date(2013, 10, 2): {
-                    'start': datetime.time(8, 30, 0),
-                    'end': datetime.time(16, 45, 0),
-                },
+        aggregates_mock.return_value = utils.build_aggregates(
+            {
+                10: {
+                    datetime.date(2013, 10, 1): {
+                        'start': datetime.time(9, 0, 0),
+                        'end': datetime.time(17, 30, 0),
+                    },
+                    datetime.date(2013, 10, 2): {
+                        'start': datetime.time(8, 30, 0),
+                        'end': datetime.time(16, 45, 0),
+                    },
+                }
             }
-        }
-        data_mock.get_user_data.return_value = {
+        )
+        user_data_mock.return_value = {
             170: {
                 'avatar': 'http:///api/images/users/170',
                 'name': 'Agata Juszczak',
@@ -135,28 +168,30 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         Test returning mean presence time of valid and invalid user.
         """
 
-        utils_mock.get_data.return_value = {
-            10: {
-                datetime.date(2013, 10, 1): {
-                    'start': datetime.time(9, 0, 0),
-                    'end': datetime.time(17, 30, 0),
-                },
-                datetime.date(2013, 10, 2): {
-                    'start': datetime.time(8, 30, 0),
-                    'end': datetime.time(16, 45, 0),
-                },
+        utils_mock.get_aggregates.return_value = utils.build_aggregates(
+            {
+                10: {
+                    datetime.date(2013, 10, 1): {
+                        'start': datetime.time(9, 0, 0),
+                        'end': datetime.time(17, 30, 0),
+                    },
+                    datetime.date(2013, 10, 2): {
+                        'start': datetime.time(8, 30, 0),
+                        'end': datetime.time(16, 45, 0),
+                    },
+                }
             }
-        }
+        )
 
         resp = self.client.get('/api/v1/mean_time_weekday/10')
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(resp.content_type, 'application/json')
-        self.assertEqual(resp.content_length, 96)
+        self.assertEqual(resp.content_length, 83)
         self.assertEqual(
             resp.data,
             '['
-            '["Mon", 0], ["Tue", 30600.0], ["Wed", 29700.0], ["Thu", 0], '
-            '["Fri", 0], ["Sat", 0], ["Sun", 0]'
+            '["Mon",0],["Tue",30600.0],["Wed",29700.0],["Thu",0],'
+            '["Fri",0],["Sat",0],["Sun",0]'
             ']'
         )
 
@@ -175,22 +210,24 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         """
         Test returning total presence time of valid and invalid user.
         """
-        utils_mock.get_data.return_value = {
-            10: {
-                datetime.date(2013, 10, 1): {
-                    'start': datetime.time(9, 0, 0),
-                    'end': datetime.time(17, 30, 0),
-                },
-                datetime.date(2013, 10, 2): {
-                    'start': datetime.time(8, 30, 0),
-                    'end': datetime.time(16, 45, 0),
-                },
+        utils_mock.get_aggregates.return_value = utils.build_aggregates(
+            {
+                10: {
+                    datetime.date(2013, 10, 1): {
+                        'start': datetime.time(9, 0, 0),
+                        'end': datetime.time(17, 30, 0),
+                    },
+                    datetime.date(2013, 10, 2): {
+                        'start': datetime.time(8, 30, 0),
+                        'end': datetime.time(16, 45, 0),
+                    },
+                }
             }
-        }
+        )
         resp = self.client.get('/api/v1/presence_weekday/10')
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(resp.content_type, 'application/json')
-        self.assertEqual(resp.content_length, 121)
+        self.assertEqual(resp.content_length, 106)
         data = json.loads(resp.data)
         self.assertEqual(len(data), 8)
         self.assertEqual(data[0], ['Weekday', 'Presence (s)'])
@@ -205,18 +242,20 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         """
         Test returning start end time of valid and invalid user.
         """
-        data_mock.get_data.return_value = {
-            10: {
-                datetime.date(2013, 10, 1): {
-                    'start': datetime.time(9, 0, 0),
-                    'end': datetime.time(17, 30, 0),
-                },
-                datetime.date(2013, 10, 2): {
-                    'start': datetime.time(8, 30, 0),
-                    'end': datetime.time(16, 45, 0),
-                },
+        data_mock.get_aggregates.return_value = utils.build_aggregates(
+            {
+                10: {
+                    datetime.date(2013, 10, 1): {
+                        'start': datetime.time(9, 0, 0),
+                        'end': datetime.time(17, 30, 0),
+                    },
+                    datetime.date(2013, 10, 2): {
+                        'start': datetime.time(8, 30, 0),
+                        'end': datetime.time(16, 45, 0),
+                    },
+                }
             }
-        }
+        )
         resp = self.client.get('/api/v1/presence_start_end/10')
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(resp.content_type, 'application/json')
@@ -229,6 +268,505 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(resp.status_code, 401)
         self.assertEqual(resp.content_type, 'text/html')
 
+    @mock.patch("presence_analyzer.views.utils")
+    def test_conditional_requests(self, utils_mock):
+        """
+        Test 304 responses for unchanged data.
+        """
+        utils_mock.get_aggregates.return_value = {10: [[0, 0, 0, 0]] * 7}
+        resp = self.client.get('/api/v1/presence_weekday/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+        etag = resp.headers['ETag']
+        last_modified = resp.headers['Last-Modified']
+        self.assertEqual(utils_mock.get_aggregates.call_count, 1)
+
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10',
+            headers={'If-None-Match': etag}
+        )
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, '')
+        self.assertEqual(resp.headers['ETag'], etag)
+        self.assertEqual(utils_mock.get_aggregates.call_count, 1)
+
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10',
+            headers={'If-Modified-Since': last_modified}
+        )
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(utils_mock.get_aggregates.call_count, 1)
+
+        # other user, other representation
+        resp = self.client.get(
+            '/api/v1/presence_weekday/11',
+            headers={'If-None-Match': etag}
+        )
+        self.assertEqual(resp.status_code, 401)
+
+        with mock.patch('presence_analyzer.utils.file_version') as version:
+            version.return_value = (TEST_DATA_CSV, 0, 0)
+            resp = self.client.get(
+                '/api/v1/presence_weekday/10',
+                headers={'If-None-Match': etag}
+            )
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+        main.app.config['CACHE_CONTROL'] = {
+            'presence_weekday_view': 'max-age=5',
+        }
+        self.addCleanup(main.app.config.pop, 'CACHE_CONTROL')
+        resp = self.client.get('/api/v1/presence_weekday/10')
+        self.assertEqual(resp.headers['Cache-Control'], 'max-age=5')
+
+    def test_conditional_background_refresh(self):
+        """
+        Test ETag and memoized response follow data swapped by refresher.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        csv_path = os.path.join(tmpdir, 'data.csv')
+        with open(csv_path, 'wb') as csvfile:
+            csvfile.write('10,2011-06-06,08:00:00,16:00:00\n')
+        main.app.config['DATA_CSV'] = csv_path
+        url = '/api/v1/presence_weekday/10'
+        etag = self.client.get(url).headers['ETag']
+
+        # requests do not check files while refresher runs
+        with mock.patch.dict(utils.REFRESHER, thread=mock.Mock()):
+            with open(csv_path, 'ab') as csvfile:
+                csvfile.write('10,2011-06-13,08:00:00,16:00:00\n')
+            resp = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+
+            utils.refresh()
+            resp = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+            self.assertEqual(json.loads(resp.data)[1], ['Mon', 57600])
+
+    @mock.patch("presence_analyzer.views.utils")
+    def test_memoized_responses(self, utils_mock):
+        """
+        Test serving chart responses from LRU cache.
+        """
+        utils_mock.get_aggregates.return_value = {
+            10: [[1, 3600, 0, 3600]] * 7,
+            11: [[0, 0, 0, 0]] * 7,
+        }
+        first = self.client.get('/api/v1/mean_time_weekday/10').data
+        self.assertEqual(
+            self.client.get('/api/v1/mean_time_weekday/10').data, first
+        )
+        self.assertEqual(utils_mock.get_aggregates.call_count, 1)
+
+        self.client.get('/api/v1/mean_time_weekday/11')
+        self.client.get('/api/v1/presence_weekday/10')
+        self.assertEqual(utils_mock.get_aggregates.call_count, 3)
+
+        utils_mock.cache_stats.return_value = {'hits': 0}
+        resp = self.client.get('/api/v1/cache_stats')
+        self.assertEqual(json.loads(resp.data)['data'], {'hits': 0})
+        stats = json.loads(resp.data)['responses']
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 3)
+        self.assertEqual(stats['entries'], 3)
+
+    def test_compressed_responses(self):
+        """
+        Test compressing JSON responses accepted by client.
+        """
+        plain = self.client.get('/api/v1/users')
+        self.assertNotIn('Content-Encoding', plain.headers)
+
+        main.app.config['JSON_COMPRESS_MIN_SIZE'] = 10
+        self.addCleanup(main.app.config.pop, 'JSON_COMPRESS_MIN_SIZE')
+        resp = self.client.get(
+            '/api/v1/users', headers={'Accept-Encoding': 'gzip, deflate'}
+        )
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(resp.content_length, len(resp.data))
+        self.assertEqual(
+            zlib.decompress(resp.data, 16 + zlib.MAX_WBITS), plain.data
+        )
+        # compressed body is kept with the cached one
+        with mock.patch.object(zlib, 'compressobj') as compressobj:
+            again = self.client.get(
+                '/api/v1/users', headers={'Accept-Encoding': 'gzip'}
+            )
+        self.assertEqual(again.data, resp.data)
+        self.assertFalse(compressobj.called)
+
+        resp = self.client.get(
+            '/api/v1/users', headers={'Accept-Encoding': 'deflate'}
+        )
+        self.assertEqual(resp.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(zlib.decompress(resp.data), plain.data)
+
+        resp = self.client.get('/api/v1/users')
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+
+        # refused encodings are skipped
+        resp = self.client.get(
+            '/api/v1/users', headers={'Accept-Encoding': 'gzip;q=0'}
+        )
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.data, plain.data)
+        resp = self.client.get(
+            '/api/v1/users', headers={'Accept-Encoding': 'gzip;q=0, *'}
+        )
+        self.assertEqual(resp.headers['Content-Encoding'], 'deflate')
+
+        # compressed bodies of memoized responses count towards cache size
+        url = '/api/v1/presence_weekday/10'
+        plain = self.client.get(url)
+        self.assertEqual(
+            helpers.RESPONSE_CACHE.stats()['bytes'], len(plain.data)
+        )
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(
+            helpers.RESPONSE_CACHE.stats()['bytes'],
+            len(plain.data) + len(resp.data)
+        )
+
+        main.app.config['JSON_COMPRESS_MIN_SIZE'] = len(plain.data) + 1
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.data, plain.data)
+
+    def test_metrics(self):
+        """
+        Test exposing request latency histograms in Prometheus format.
+        """
+        metrics.clear()
+        self.client.get('/api/v1/presence_weekday/10')
+        self.client.get('/api/v1/presence_weekday/10')
+        self.client.get('/api/v1/presence_weekday/56')
+
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/plain')
+        lines = resp.data.splitlines()
+        self.assertIn(
+            'presence_requests_total{endpoint="presence_weekday_view",'
+            'method="GET",status="200"} 2',
+            lines
+        )
+        self.assertIn(
+            'presence_requests_total{endpoint="presence_weekday_view",'
+            'method="GET",status="401"} 1',
+            lines
+        )
+        self.assertIn(
+            'presence_request_duration_seconds_bucket'
+            '{endpoint="presence_weekday_view",le="+Inf"} 3',
+            lines
+        )
+        # every request checks data version, second one is memoized,
+        # third one fails after loading data
+        for phase, count in (('load', 3), ('aggregate', 1),
+                             ('serialize', 2)):
+            self.assertIn(
+                'presence_request_phase_seconds_count'
+                '{{endpoint="presence_weekday_view",phase="{0}"}} {1}'
+                .format(phase, count),
+                lines
+            )
+
+        # unhandled exceptions are counted too
+        with mock.patch.object(main.app, 'log_exception'):
+            with mock.patch('presence_analyzer.helpers.mean_time_weekday',
+                            side_effect=RuntimeError):
+                resp = self.client.get('/api/v1/mean_time_weekday/10')
+        self.assertEqual(resp.status_code, 500)
+        lines = metrics.render().splitlines()
+        self.assertIn(
+            'presence_requests_total{endpoint="mean_time_weekday_view",'
+            'method="GET",status="500"} 1',
+            lines
+        )
+        self.assertIn(
+            'presence_request_duration_seconds_count'
+            '{endpoint="mean_time_weekday_view"} 1',
+            lines
+        )
+
+        # loading and aggregating date range are timed separately
+        metrics.start_request()
+        utils.get_range_aggregates(10, datetime.date(2013, 9, 10))
+        phases = metrics._local.phases  # pylint: disable=W0212
+        metrics._local.started = None  # pylint: disable=W0212
+        self.assertItemsEqual(phases, ['load', 'aggregate'])
+
+        histogram = metrics.Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+        self.assertEqual(
+            histogram.cumulative(), [(0.1, 2), (1.0, 3), ('+Inf', 4)]
+        )
+        self.assertEqual(histogram.sum, 2.65)
+
+    def test_profiling(self):
+        """
+        Test profiling requests on demand and by sampling.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        resp = self.client.get('/debug/profile/api/v1/users')
+        self.assertEqual(resp.status_code, 404)
+
+        main.app.config.update({'PROFILING': True, 'PROFILE_DIR': tmpdir})
+        self.addCleanup(main.app.config.pop, 'PROFILING')
+        self.addCleanup(main.app.config.pop, 'PROFILE_DIR')
+        resp = self.client.get('/debug/profile/api/v1/users')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/plain')
+        self.assertTrue(resp.data.startswith('/api/v1/users 200 OK\n'))
+        self.assertIn('get_users_json', resp.data)
+
+        plain = self.client.get('/api/v1/users')
+        resp = self.client.get('/api/v1/users', headers={'X-Profile': '1'})
+        self.assertEqual(resp.data, plain.data)
+        name = resp.headers['X-Profile']
+        self.assertTrue(name.startswith('api.v1.users-'))
+        stats = pstats.Stats(os.path.join(tmpdir, name))
+        self.assertGreater(stats.total_calls, 0)
+
+        main.app.config['PROFILE_SAMPLE_RATE'] = 2
+        self.addCleanup(main.app.config.pop, 'PROFILE_SAMPLE_RATE')
+        main.app.wsgi_app.counter = itertools.count(1)
+        for _ in range(4):
+            self.assertEqual(
+                self.client.get('/api/v1/users').data, plain.data
+            )
+        sampled = os.path.join(tmpdir, 'sampled-{0}.prof'.format(os.getpid()))
+        self.assertEqual(
+            pstats.Stats(sampled).stats,
+            main.app.wsgi_app.sampled.stats
+        )
+        self.assertItemsEqual(
+            os.listdir(tmpdir), [name, os.path.basename(sampled)]
+        )
+
+    def test_json_backends(self):
+        """
+        Test serializing compact JSON with configured encoder.
+        """
+        self.assertEqual(helpers.JSON_BACKENDS[-1][0], 'json')
+        self.assertEqual(helpers.dumps([('Mon', 0), {'a': 1}]),
+                         '[["Mon",0],{"a":1}]')
+        main.app.config['JSON_BACKEND'] = 'json'
+        self.addCleanup(main.app.config.pop, 'JSON_BACKEND')
+        self.assertEqual(helpers.dumps([1.5]), '[1.5]')
+        main.app.config['JSON_BACKEND'] = 'unknown'
+        with self.assertRaises(KeyError):
+            helpers.dumps([])
+
+    def test_lru_cache(self):
+        """
+        Test LRU eviction by number of entries and size.
+        """
+        cache = lru.LRUCache(max_entries=2, max_bytes=10)
+        cache.put('a', '1234')
+        cache.put('b', '1234')
+        self.assertEqual(cache.get('a'), '1234')
+        cache.put('c', '1234')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), '1234')
+
+        cache.put('d', '12345678')
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNone(cache.get('c'))
+        cache.put('e', '12345678901')
+        self.assertIsNone(cache.get('e'))
+        self.assertEqual(
+            cache.stats(),
+            {
+                'hits': 2, 'misses': 4, 'evictions': 3,
+                'entries': 1, 'bytes': 8,
+                'max_entries': 2, 'max_bytes': 10,
+            }
+        )
+
+        cache.resize(2, 4)
+        self.assertEqual(cache.stats()['entries'], 0)
+
+        # size of value changed after it was cached
+        value = ['1234']
+        cache = lru.LRUCache(max_entries=2, max_bytes=10, sizeof=lambda value:
+                             sum(len(part) for part in value))
+        cache.put('a', ['12'])
+        cache.put('b', value)
+        value.append('12')
+        cache.recount('b', value)
+        self.assertEqual(cache.stats()['bytes'], 8)
+        cache.recount('a', ['1234'])
+        self.assertEqual(cache.stats()['bytes'], 8)
+        value.append('123')
+        cache.recount('b', value)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['bytes'], 9)
+        value.append('12345')
+        cache.recount('b', value)
+        self.assertEqual(cache.stats()['entries'], 0)
+        self.assertEqual(cache.stats()['bytes'], 0)
+
+    @mock.patch("presence_analyzer.views.utils")
+    def test_stats_view(self, utils_mock):
+        """
+        Test statistics of many users in one response.
+        """
+        aggregates = {
+            10: [[2, 7200, 57600, 64800]] + [[0, 0, 0, 0]] * 6,
+            11: [[0, 0, 0, 0]] * 7,
+        }
+        utils_mock.get_aggregates.return_value = aggregates
+        utils_mock.get_users_aggregates.side_effect = lambda user_ids: dict(
+            (user_id, aggregates[user_id])
+            for user_id in user_ids if user_id in aggregates
+        )
+
+        resp = self.client.get('/api/v1/stats?users=10,12')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['user_id'], 10)
+        for endpoint in ('mean_time_weekday', 'presence_weekday',
+                         'presence_start_end'):
+            self.assertEqual(
+                data[0][endpoint],
+                json.loads(
+                    self.client.get(
+                        '/api/v1/{0}/10'.format(endpoint)
+                    ).data
+                )
+            )
+
+        resp = self.client.get('/api/v1/stats?users=all')
+        self.assertEqual(
+            [user['user_id'] for user in json.loads(resp.data)], [10, 11]
+        )
+
+        for users in ('ten', '', '10,,'):
+            resp = self.client.get('/api/v1/stats?users=' + users)
+            self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/stats')
+        self.assertEqual(json.loads(resp.data), [])
+
+    def test_date_range(self):
+        """
+        Test limiting chart statistics to date range.
+        """
+        resp = self.client.get(
+            '/api/v1/presence_weekday/11?from=2013-09-10&to=2013-09-12'
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            json.loads(resp.data)[1:],
+            [['Mon', 0], ['Tue', 16564], ['Wed', 25321], ['Thu', 22969],
+             ['Fri', 0], ['Sat', 0], ['Sun', 0]]
+        )
+
+        resp = self.client.get('/api/v1/mean_time_weekday/11?from=2013-09-13')
+        self.assertEqual(json.loads(resp.data)[4], ['Fri', 6426.0])
+
+        resp = self.client.get('/api/v1/stats?users=all&to=2013-09-05')
+        data = json.loads(resp.data)
+        self.assertEqual(data[0]['presence_weekday'][4], ['Thu', 0])
+        self.assertEqual(data[1]['presence_weekday'][4], ['Thu', 22999])
+
+        resp = self.client.get('/api/v1/presence_start_end/11?from=2013-13-01')
+        self.assertEqual(resp.status_code, 400)
+
+        stores = ['dict']
+        if columnar.load_numpy() is not None:
+            stores.append('columnar')
+        self.addCleanup(main.app.config.pop, 'PRESENCE_STORE', None)
+        for store in stores:
+            main.app.config['PRESENCE_STORE'] = store
+            resp = self.client.get(
+                '/api/v1/presence_weekday/11?from=2013-09-12&to=2013-09-09'
+            )
+            self.assertEqual(resp.status_code, 400)
+
+    def test_presence_totals(self):
+        """
+        Test company-wide presence totals.
+        """
+        resp = self.client.get('/api/v1/presence_totals')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 9)
+        self.assertEqual(
+            data[0],
+            {'start': '2013-09-05', 'end': '2013-09-05',
+             'total': 22999, 'headcount': 1}
+        )
+        self.assertEqual(data[5]['headcount'], 2)
+        self.assertEqual(
+            sum(period['total'] for period in data),
+            sum(total for user in utils.get_aggregates().values()
+                for _, total, _, _ in user)
+        )
+        # dates without data are clipped
+        for query in ('from=0001-01-01', 'to=9999-12-31', 'users=all'):
+            resp = self.client.get('/api/v1/presence_totals?' + query)
+            self.assertEqual(json.loads(resp.data), data)
+        resp = self.client.get('/api/v1/presence_totals?from=2014-01-01')
+        self.assertEqual(json.loads(resp.data), [])
+
+        resp = self.client.get(
+            '/api/v1/presence_totals?period=weekly&from=2013-09-06'
+        )
+        data = json.loads(resp.data)
+        self.assertEqual(
+            [(period['start'], period['end'], period['headcount'])
+             for period in data],
+            [('2013-09-06', '2013-09-08', 0), ('2013-09-09', '2013-09-13', 8)]
+        )
+
+        resp = self.client.get(
+            '/api/v1/presence_totals?period=monthly&users=10'
+        )
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['headcount'], 3)
+        self.assertEqual(
+            data[0]['total'],
+            sum(total for _, total, _, _ in utils.get_aggregates()[10])
+        )
+
+        resp = self.client.get('/api/v1/presence_totals?period=yearly')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/presence_totals?users=')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_ready(self):
+        """
+        Test readiness check waiting for warmed up data.
+        """
+        main.app.config['PREWARM'] = True
+        self.addCleanup(main.app.config.pop, 'PREWARM')
+        utils.WARM_UP['done'].clear()
+        resp = self.client.get('/ready')
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertFalse(json.loads(resp.data)['ready'])
+
+        utils.warm_up()
+        resp = self.client.get('/ready')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertTrue(data['ready'])
+        self.assertIn('load_presence.parse', data['timings'])
+
+        main.app.config['PREWARM'] = False
+        utils.WARM_UP['done'].clear()
+        self.assertEqual(self.client.get('/ready').status_code, 200)
+
 
 class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
     """
@@ -244,13 +782,14 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
                 'USERS_XML': TEST_USERS_XML,
             }
         )
+        utils.clear_cache()
 
     @mock.patch('presence_analyzer.utils.open', create=True)
     def test_get_user_data(self, mock_open):
         """
         Test test_get_user_data.
         """
-        test_lines = u"""
+        test_lines = """
 <intranet>
     <server>
         <host>intranet.stxnext.pl</host>
@@ -473,6 +1012,865 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertIsNotNone(result[2])
         self.assertIsNotNone(result[3])
 
+    @mock.patch("presence_analyzer.utils.csv")
+    @mock.patch('presence_analyzer.utils.open', create=True)
+    def test_get_data_cache(self, mock_open, csv_mock):
+        """
+        Test serving presence data from cache until file changes.
+        """
+        csv_mock.reader.return_value = [
+            ['10', '2013-01-01', '07:39:21', '15:23:01'],
+        ]
+        data = utils.get_data()
+        self.assertIs(utils.get_data(), data)
+        self.assertEqual(csv_mock.reader.call_count, 1)
+        self.assertEqual(
+            utils.cache_stats(),
+            {'hits': 1, 'misses': 1, 'reloads': 0, 'updates': 0}
+        )
+
+        with mock.patch('presence_analyzer.utils.file_version') as version:
+            version.return_value = (TEST_DATA_CSV, 0, 0)
+            self.assertIsNot(utils.get_data(), data)
+            self.assertEqual(csv_mock.reader.call_count, 2)
+        self.assertEqual(
+            utils.cache_stats(),
+            {'hits': 1, 'misses': 1, 'reloads': 1, 'updates': 0}
+        )
+
+    def test_parse_row(self):
+        """
+        Test fast row parsing and fallback to strict parsing.
+        """
+        expected = (
+            10,
+            datetime.date(2013, 1, 2),
+            datetime.time(7, 39, 21),
+            datetime.time(15, 23, 1),
+        )
+        row = ['10', '2013-01-02', '07:39:21', '15:23:01']
+        self.assertEqual(utils.parse_row(row), expected)
+        self.assertEqual(utils.parse_row_strict(row), expected)
+
+        # not zero padded, handled by strict parser
+        row = ['10', '2013-1-2', '7:39:21', '15:23:01']
+        self.assertEqual(utils.parse_row(row), expected)
+
+        for row in (['10', '2013-02-30', '07:39:21', '15:23:01'],
+                    ['10', '2013-01-02', '07:39:21', '15:23:1x'],
+                    ['10', '2013-01-02', '07:39:21', '25:23:01'],
+                    ['x', '2013-01-02', '07:39:21', '15:23:01']):
+            self.assertRaises(ValueError, utils.parse_row, row)
+
+    @mock.patch("presence_analyzer.utils.csv")
+    @mock.patch('presence_analyzer.utils.open', create=True)
+    def test_get_aggregates(self, mock_open, csv_mock):
+        """
+        Test weekday aggregates built together with presence data.
+        """
+        csv_mock.reader.return_value = [
+            ['10', '2011-06-06', '08:00:00', '16:00:00'],
+            ['10', '2011-06-13', '09:00:00', '16:30:00'],
+            ['10', '2011-06-14', '10:00:00', '12:00:00'],
+            ['11', '2011-06-14', '10:00:00', '12:00:00'],
+        ]
+        aggregates = utils.get_aggregates()
+        self.assertItemsEqual(aggregates.keys(), [10, 11])
+        self.assertEqual(aggregates[10][0], [2, 55800, 61200, 117000])
+        self.assertEqual(aggregates[10][1], [1, 7200, 36000, 43200])
+        self.assertEqual(aggregates[10][2], [0, 0, 0, 0])
+        self.assertEqual(csv_mock.reader.call_count, 1)
+
+        data = utils.get_data()
+        weekdays = helpers.group_by_weekday(data[10])
+        self.assertEqual(
+            helpers.mean_time_weekday(aggregates[10]),
+            [(day, helpers.mean(weekdays[i]))
+             for i, day in enumerate(calendar.day_abbr)]
+        )
+        self.assertEqual(
+            helpers.presence_start_end(aggregates[10])[0],
+            ('Mon', 30600.0, 58500.0)
+        )
+        self.assertEqual(
+            helpers.presence_weekday(aggregates[10])[:2],
+            [('Weekday', 'Presence (s)'), ('Mon', 55800)]
+        )
+
+    @unittest.skipIf(columnar.load_numpy() is None, 'numpy is not installed')
+    @mock.patch("presence_analyzer.utils.csv")
+    @mock.patch('presence_analyzer.utils.open', create=True)
+    def test_columnar_store(self, mock_open, csv_mock):
+        """
+        Test columnar store gives the same results as dict structure.
+        """
+        csv_mock.reader.return_value = [
+            ['11', '2011-06-14', '10:00:00', '12:00:00'],
+            ['10', '2011-06-06', '08:00:00', '16:00:00'],
+            ['10', '2011-06-13', '09:00:00', '16:30:00'],
+            ['10', '2011-06-14', '10:00:00', '12:00:00'],
+            ['10', '2011-06-06', '07:00:00', '15:00:00'],
+        ]
+        data = utils.get_data()
+        store = columnar.ColumnarStore.from_data(data)
+
+        self.assertEqual(len(store), 4)
+        self.assertIn(10, store)
+        self.assertNotIn(12, store)
+        self.assertEqual(store.to_data(), data)
+        self.assertEqual(store.aggregates(), utils.build_aggregates(data))
+        self.assertEqual(
+            store.weekday_aggregates(10),
+            helpers.weekday_aggregates(data[10])
+        )
+        self.assertEqual(store.weekday_aggregates(12), [[0, 0, 0, 0]] * 7)
+        self.assertEqual(list(store.group_by_weekday(10)[0]), [28800, 27000])
+        self.assertEqual(store.sum_by_weekday(10)[0], 55800)
+        self.assertEqual(store.mean_by_weekday(10)[0], 27900.0)
+
+        main.app.config['PRESENCE_STORE'] = 'columnar'
+        try:
+            # changed store is loaded again
+            self.assertIn('columns', utils.load_presence())
+            self.assertEqual(utils.get_data(), data)
+            self.assertIs(utils.get_data(), utils.get_data())
+            self.assertEqual(
+                utils.get_aggregates(),
+                utils.build_aggregates(data)
+            )
+            self.assertEqual(utils.get_timeline(), utils.build_timeline(data))
+            self.assertEqual(
+                utils.get_users_timeline([10]),
+                utils.build_timeline({10: data[10]})
+            )
+        finally:
+            main.app.config['PRESENCE_STORE'] = 'dict'
+
+    def test_snapshot(self):
+        """
+        Test loading presence data from binary snapshot.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        csv_path = os.path.join(tmpdir, 'data.csv')
+        snapshot_path = os.path.join(tmpdir, 'data.snapshot')
+        shutil.copy(TEST_DATA_CSV, csv_path)
+        main.app.config.update({
+            'DATA_CSV': csv_path,
+            'DATA_SNAPSHOT': snapshot_path,
+        })
+        self.addCleanup(main.app.config.pop, 'DATA_SNAPSHOT')
+
+        self.assertIsNone(utils.open_snapshot())
+        expected = utils.get_data()
+        self.assertEqual(utils.build_snapshot(), 9)
+
+        presence_snapshot = utils.open_snapshot()
+        self.assertEqual(presence_snapshot.to_data(), expected)
+        self.assertItemsEqual(presence_snapshot.users().keys(), [10, 11])
+        self.assertEqual(
+            presence_snapshot.user_records(11)[0],
+            (11, datetime.date(2013, 9, 5).toordinal(), 34088, 57087)
+        )
+        if columnar.load_numpy() is not None:
+            self.assertEqual(
+                presence_snapshot.to_columns().aggregates(),
+                utils.build_aggregates(expected)
+            )
+        presence_snapshot.close()
+
+        utils.clear_cache()
+        with mock.patch('presence_analyzer.utils.read_data') as read_data:
+            self.assertEqual(utils.get_data(), expected)
+            self.assertFalse(read_data.called)
+
+        # touched, but same content
+        os.utime(csv_path, (0, 0))
+        self.assertIsNotNone(utils.open_snapshot())
+
+        with open(csv_path, 'ab') as csvfile:
+            csvfile.write('\n11,2013-09-06,09:00:00,15:00:00')
+        self.assertIsNone(utils.open_snapshot())
+
+        with open(snapshot_path, 'wb') as snapshot_file:
+            snapshot_file.write('garbage')
+        self.assertRaises(
+            snapshot.SnapshotError, snapshot.Snapshot, snapshot_path
+        )
+        self.assertIsNone(utils.open_snapshot())
+
+    def test_get_data_appended_rows(self):
+        """
+        Test merging rows appended to CSV file without full reload.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        csv_path = os.path.join(tmpdir, 'data.csv')
+        main.app.config['DATA_CSV'] = csv_path
+        with open(csv_path, 'wb') as csvfile:
+            csvfile.write(
+                'user_id,date,start,end\n'
+                '10,2011-06-06,08:00:00,16:00:00\n'
+                '10,2011-06-07,08:00:00,16:00:00'
+            )
+        data = utils.get_data()
+        self.assertEqual(len(data[10]), 2)
+
+        with open(csv_path, 'ab') as csvfile:
+            csvfile.write(
+                '\n10,2011-06-13,09:00:00,16:30:00\n'
+                '10,2011-06-07,10:00:00,12:00:00\n'
+                '11,2011-06-14,10:00:00,12:00:00\n'
+            )
+        with mock.patch('presence_analyzer.utils.read_data') as read_data:
+            updated = utils.get_data()
+            self.assertFalse(read_data.called)
+
+        self.assertEqual(len(data[10]), 2)
+        self.assertEqual(len(updated[10]), 3)
+        self.assertEqual(
+            updated[10][datetime.date(2011, 6, 7)]['start'],
+            datetime.time(10, 0, 0)
+        )
+        self.assertEqual(utils.cache_stats()['updates'], 1)
+        self.assertEqual(
+            utils.get_aggregates(),
+            utils.build_aggregates(updated)
+        )
+        self.assertEqual(
+            utils.load_presence()['date_index'],
+            utils.build_date_index(updated)
+        )
+        self.assertEqual(
+            utils.get_timeline(),
+            utils.build_timeline(updated)
+        )
+
+        # rewritten file is loaded from scratch
+        with open(csv_path, 'r+b') as csvfile:
+            csvfile.seek(-len('11,2011-06-14,10:00:00,12:00:00\n'), 2)
+            csvfile.write('12,2011-06-14,10:00:00,12:00:00\n')
+            csvfile.write('12,2011-06-15,10:00:00,12:00:00\n')
+        self.assertItemsEqual(utils.get_data().keys(), [10, 12])
+        self.assertEqual(utils.cache_stats()['reloads'], 1)
+
+        # so is truncated file
+        with open(csv_path, 'wb') as csvfile:
+            csvfile.write('13,2011-06-14,10:00:00,12:00:00\n')
+        self.assertItemsEqual(utils.get_data().keys(), [13])
+        self.assertEqual(utils.cache_stats()['reloads'], 2)
+
+    def test_get_data_unfinished_line(self):
+        """
+        Test merging appended line only after it is finished.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        csv_path = os.path.join(tmpdir, 'data.csv')
+        main.app.config['DATA_CSV'] = csv_path
+        with open(csv_path, 'wb') as csvfile:
+            csvfile.write('10,2011-06-06,08:00:00,16:00:00\n')
+        utils.get_data()
+
+        with open(csv_path, 'ab') as csvfile:
+            csvfile.write('10,2011-06-07,08:00:00,13:30:40')
+        self.assertNotIn(datetime.date(2011, 6, 7), utils.get_data()[10])
+
+        # finished line turns out malformed
+        with open(csv_path, 'ab') as csvfile:
+            csvfile.write('1\n10,2011-06-08,08:00:00,16:00:00\n')
+        presence = utils.load_presence()
+        self.assertEqual(utils.cache_stats()['updates'], 2)
+        utils.clear_cache()
+        expected = utils.load_presence()
+        for key in ('data', 'aggregates', 'date_index', 'timeline'):
+            self.assertEqual(presence[key], expected[key])
+
+    def test_timeline_appended_rows_in_range(self):
+        """
+        Test timeline after merging rows dated inside its range.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        csv_path = os.path.join(tmpdir, 'data.csv')
+        main.app.config['DATA_CSV'] = csv_path
+        with open(csv_path, 'wb') as csvfile:
+            csvfile.write(
+                '10,2013-09-02,08:00:00,16:00:00\n'
+                '10,2013-09-05,08:00:00,16:00:00\n'
+            )
+        utils.get_timeline()
+
+        with open(csv_path, 'ab') as csvfile:
+            csvfile.write(
+                '11,2013-09-02,09:00:00,17:00:00\n'
+                '11,2013-09-03,09:00:00,17:00:00\n'
+                '10,2013-09-05,10:00:00,12:00:00\n'
+            )
+        merged = utils.get_timeline()
+        self.assertEqual(utils.cache_stats()['updates'], 1)
+        utils.clear_cache()
+        self.assertEqual(merged, utils.get_timeline())
+
+    def test_timeline_touched_file(self):
+        """
+        Test timeline after merging touched file without new rows.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        csv_path = os.path.join(tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, csv_path)
+        main.app.config['DATA_CSV'] = csv_path
+        utils.get_timeline()
+
+        for mtime in (1000000000, 1000000001):
+            os.utime(csv_path, (mtime, mtime))
+            merged = utils.get_timeline()
+        self.assertEqual(utils.cache_stats()['updates'], 2)
+        utils.clear_cache()
+        self.assertEqual(merged, utils.get_timeline())
+
+    @mock.patch("presence_analyzer.utils.get_user_data")
+    def test_get_users_json(self, user_data_mock):
+        """
+        Test caching of serialized users listing.
+        """
+        user_data_mock.return_value = {
+            10: {'avatar': 'http://x/10', 'name': 'John'},
+            12: {'avatar': 'http://x/12', 'name': 'Mark'},
+        }
+        listing = utils.get_users_json()
+        self.assertIsInstance(listing, helpers.Serialized)
+        self.assertEqual(
+            json.loads(listing),
+            [{'user_id': 10, 'name': 'John', 'avatar': 'http://x/10'}]
+        )
+        self.assertIs(utils.get_users_json(), listing)
+        self.assertEqual(user_data_mock.call_count, 1)
+
+        # changing either file invalidates the listing
+        versions = {
+            TEST_DATA_CSV: (TEST_DATA_CSV, 0, 0),
+            TEST_USERS_XML: (TEST_USERS_XML, 0, 0),
+        }
+        for path, version in versions.iteritems():
+            with mock.patch('presence_analyzer.utils.file_version') as patch:
+                patch.side_effect = lambda name: (
+                    version if name == path else (name, 1, 1)
+                )
+                utils.get_users_json()
+        self.assertEqual(user_data_mock.call_count, 3)
+
+    def test_iter_user_data(self):
+        """
+        Test streaming users XML with server header after users.
+        """
+        xmlfile = StringIO(
+            '<intranet><users>'
+            '<user id="141"><avatar>/a/141</avatar><name>John</name></user>'
+            '<user id="176"><avatar>/a/176</avatar><name>Adrian</name></user>'
+            '</users><server><host>example.com</host>'
+            '<protocol>http</protocol></server></intranet>'
+        )
+        self.assertEqual(
+            list(utils.iter_user_data(xmlfile)),
+            [
+                (141, {'avatar': 'http://example.com/a/141', 'name': 'John'}),
+                (176, {'avatar': 'http://example.com/a/176',
+                       'name': 'Adrian'}),
+            ]
+        )
+
+    def test_range_aggregates(self):
+        """
+        Test date range queries against full scan.
+        """
+        data = utils.get_data()
+        for first, last in ((None, None),
+                            (datetime.date(2013, 9, 9), None),
+                            (None, datetime.date(2013, 9, 11)),
+                            (datetime.date(2013, 9, 10),
+                             datetime.date(2013, 9, 10)),
+                            (datetime.date(2014, 1, 1), None)):
+            for user_id in data:
+                items = {
+                    day: start_end
+                    for day, start_end in data[user_id].iteritems()
+                    if (first is None or day >= first) and
+                    (last is None or day <= last)
+                }
+                expected = helpers.weekday_aggregates(items)
+                self.assertEqual(
+                    utils.get_range_aggregates(user_id, first, last),
+                    expected
+                )
+                if columnar.load_numpy() is not None:
+                    store = columnar.ColumnarStore.from_data(data)
+                    self.assertEqual(
+                        store.weekday_aggregates(user_id, first, last),
+                        expected
+                    )
+        self.assertEqual(
+            utils.get_range_aggregates(12), [[0, 0, 0, 0]] * 7
+        )
+        # inverted range is empty
+        for user_id in data:
+            self.assertEqual(
+                helpers.range_aggregates(
+                    helpers.date_index(data[user_id]),
+                    datetime.date(2013, 9, 12), datetime.date(2013, 9, 9)
+                ),
+                [[0, 0, 0, 0]] * 7
+            )
+
+    def test_read_columns_parallel(self):
+        """
+        Test parallel CSV parsing matches serial parsing.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        csv_path = os.path.join(tmpdir, 'data.csv')
+        with open(TEST_DATA_CSV, 'rb') as source:
+            content = source.read()
+        with open(csv_path, 'wb') as csvfile:
+            csvfile.write('user_id,date,start,end\n')
+            csvfile.write(content)
+            # duplicated date, last row wins
+            csvfile.write('\n10,2013-09-10,08:00:00,16:00:00\nfooter')
+        main.app.config['DATA_CSV'] = csv_path
+        expected = utils.load_presence()
+        size = os.path.getsize(csv_path)
+
+        for workers in (1, 2, 3, 50):
+            chunks = utils._chunks(csv_path, workers, size)
+            self.assertEqual(chunks[0][0], 0)
+            self.assertEqual(chunks[-1][1], size)
+            columns = utils.read_columns_parallel(csv_path, workers)
+            self.assertEqual(
+                utils.columns_to_data(*columns), expected['data']
+            )
+
+        main.app.config['DATA_CSV_WORKERS'] = 2
+        self.addCleanup(main.app.config.pop, 'DATA_CSV_WORKERS')
+        # processes are not forked by threads loading data
+        utils.clear_cache()
+        with mock.patch('multiprocessing.Pool') as pool:
+            presence = utils.load_presence()
+        self.assertFalse(pool.called)
+        self.assertEqual(presence['data'], expected['data'])
+
+        self.addCleanup(utils.stop_workers)
+        utils.start_workers(2)
+        utils.clear_cache()
+        with mock.patch(
+                'presence_analyzer.utils.read_columns_parallel',
+                wraps=utils.read_columns_parallel) as read_columns:
+            presence = utils.load_presence()
+        read_columns.assert_called_once_with(
+            csv_path, 2, os.path.getsize(csv_path), utils.WORKERS['pool']
+        )
+        for key in ('data', 'aggregates', 'timeline', 'offset', 'tail'):
+            self.assertEqual(presence[key], expected[key])
+
+    def test_background_refresh(self):
+        """
+        Test swapping data reloaded by background refresher.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        csv_path = os.path.join(tmpdir, 'data.csv')
+        with open(csv_path, 'wb') as csvfile:
+            csvfile.write('10,2011-06-06,08:00:00,16:00:00\n')
+        main.app.config['DATA_CSV'] = csv_path
+
+        self.addCleanup(utils.stop_refresher)
+        utils.start_refresher(0.01)
+        for _ in range(500):
+            if 'load_presence' in utils.CACHE:
+                break
+            time.sleep(0.01)
+        with mock.patch('presence_analyzer.utils.file_version') as version:
+            version.side_effect = AssertionError('request checks files')
+            self.assertItemsEqual(utils.get_data().keys(), [10])
+
+        with open(csv_path, 'ab') as csvfile:
+            csvfile.write('11,2011-06-06,08:00:00,16:00:00\n')
+        for _ in range(500):
+            if 11 in utils.get_data():
+                break
+            time.sleep(0.01)
+        self.assertItemsEqual(utils.get_data().keys(), [10, 11])
+        self.assertItemsEqual(utils.get_aggregates().keys(), [10, 11])
+
+        utils.stop_refresher()
+        self.assertIsNone(utils.REFRESHER['thread'])
+
+    def test_warm_up(self):
+        """
+        Test loading all data before first request.
+        """
+        timings = utils.warm_up()
+        self.assertItemsEqual(
+            utils.CACHE,
+            ['load_presence', 'get_user_data', 'get_users_json']
+        )
+        self.assertItemsEqual(timings, [
+            'load_presence', 'get_user_data', 'get_users_json',
+            'load_presence.parse', 'load_presence.aggregates',
+            'load_presence.date_index', 'load_presence.timeline',
+        ])
+        self.assertTrue(all(seconds >= 0 for seconds in timings.values()))
+        self.assertEqual(utils.WARM_UP['timings'], timings)
+        self.assertTrue(utils.WARM_UP['done'].is_set())
+
+        # failed attempts are retried, refresher starts afterwards
+        with mock.patch.multiple('presence_analyzer.utils',
+                                 warm_up=mock.DEFAULT, sleep=mock.DEFAULT,
+                                 start_refresher=mock.DEFAULT) as mocks:
+            mocks['warm_up'].side_effect = [IOError, IOError, {}]
+            utils._warm_up_safely(5)  # pylint: disable=W0212
+        self.assertEqual(mocks['warm_up'].call_count, 3)
+        self.assertEqual(
+            mocks['sleep'].call_args_list, [mock.call(1.0), mock.call(2.0)]
+        )
+        mocks['start_refresher'].assert_called_once_with(5)
+
+    def test_lazy_imports(self):
+        """
+        Test heavy modules are not imported on app or script startup.
+        """
+        seconds, loaded = benchmarks.import_modules(
+            'presence_analyzer', 'presence_analyzer.script'
+        )
+        self.assertGreater(seconds, 0)
+        self.assertIn('presence_analyzer.views', loaded)
+        for name in ('lxml', 'numpy', 'paste', 'requests',
+                     'werkzeug.script', 'multiprocessing'):
+            self.assertNotIn(name, loaded)
+
+        _, loaded = benchmarks.import_modules('presence_analyzer.loadtest')
+        self.assertIn('presence_analyzer.percentiles', loaded)
+        for name in ('presence_analyzer.benchmarks', 'lxml'):
+            self.assertNotIn(name, loaded)
+
+    def test_benchmark_suite(self):
+        """
+        Test synthetic data generator and benchmark suite results.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        csv_path, xml_path = benchmarks.write_synthetic_data(tmpdir, 3, 1)
+        with open(csv_path, 'rb') as csvfile:
+            data = utils.read_data(csvfile)
+        self.assertItemsEqual(data, [1, 2, 3])
+        self.assertEqual(len(data[1]), 365)
+        with open(xml_path, 'rb') as xmlfile:
+            self.assertItemsEqual(
+                dict(utils.iter_user_data(xmlfile)), [1, 2, 3]
+            )
+        content = open(csv_path, 'rb').read()
+        benchmarks.write_synthetic_data(tmpdir, 3, 1)
+        self.assertEqual(open(csv_path, 'rb').read(), content)
+
+        self.assertEqual(percentiles.percentile([3, 1, 2, 4], 0.5), 2)
+        self.assertEqual(percentiles.percentile(range(1, 101), 0.95), 95)
+        self.assertEqual(percentiles.percentile([7], 0.95), 7)
+
+        results = benchmarks.run(['suite'], scale=2, years=1, repeat=2)
+        self.assertItemsEqual(results['suite'], [
+            'get_data', 'get_user_data', 'group_by_weekday',
+            'group_start_end_times_by_weekday',
+        ] + ['view:' + url for url in benchmarks.SUITE_URLS])
+        for result in results['suite'].values():
+            self.assertEqual(result['samples'], 2)
+            self.assertLessEqual(result['min'], result['p95'])
+        self.assertEqual(main.app.config['DATA_CSV'], TEST_DATA_CSV)
+
+        output = os.path.join(tmpdir, 'results.json')
+        benchmarks.write_results(output, results, scale=2)
+        with open(output) as results_file:
+            self.assertEqual(
+                json.load(results_file),
+                {'options': {'scale': 2}, 'results': results}
+            )
+
+    def test_benchmark_baseline(self):
+        """
+        Test comparing benchmark results with stored baseline.
+        """
+        def result(median, p95):
+            return {'median': median, 'p95': p95, 'min': median}
+
+        baseline = {'suite': {
+            'stable': result(0.1, 0.11),
+            'noisy': result(0.1, 0.2),
+            'slower': result(0.1, 0.11),
+            'tiny': result(0.0001, 0.0001),
+            'gone': result(0.1, 0.1),
+        }, 'parser': {'fast': {'seconds': 1}}}
+        current = {'suite': {
+            'stable': result(0.105, 0.115),
+            'noisy': result(0.15, 0.2),
+            'slower': result(0.12, 0.13),
+            'tiny': result(0.0003, 0.0003),
+            'added': result(0.1, 0.1),
+        }}
+        rows = benchmarks.compare(baseline, current, threshold=10)
+        self.assertEqual(
+            [(row[0], row[-1]) for row in rows],
+            [
+                ('suite.added', 'new'),
+                ('suite.gone', 'missing'),
+                ('suite.noisy', 'ok'),
+                ('suite.slower', 'slower'),
+                ('suite.stable', 'ok'),
+                ('suite.tiny', 'ok'),
+            ]
+        )
+        self.assertEqual(
+            benchmarks.compare(current, baseline, threshold=10)[3][-1],
+            'faster'
+        )
+        table = benchmarks.diff_table(rows).splitlines()
+        self.assertEqual(len(table), 7)
+        self.assertIn('+20.0%', table[4])
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'var', 'baseline.json')
+        with mock.patch('presence_analyzer.benchmarks.run') as run, \
+                mock.patch('sys.stdout', StringIO()):
+            run.return_value = baseline
+            self.assertEqual(benchmarks.check(path, repeat=5), 0)
+            run.assert_called_with(['suite'], scale=100, years=2, repeat=5)
+
+            run.return_value = current
+            self.assertEqual(benchmarks.check(path), 1)
+            run.assert_called_with(
+                ['parser', 'suite'], scale=100, years=2, repeat=5
+            )
+            self.assertEqual(benchmarks.check(path, threshold=100), 0)
+
+            self.assertEqual(benchmarks.check(path, update=True), 0)
+            self.assertEqual(benchmarks.check(path), 0)
+
+    def test_loadtest(self):
+        """
+        Test replaying frontend traffic against running server.
+        """
+        server = simple_server.make_server(
+            '127.0.0.1', 0, main.app, handler_class=QuietHandler
+        )
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        results = loadtest.LoadTest(
+            'http://127.0.0.1:{0}'.format(server.server_port),
+            concurrency=2, duration=0.5, charts=2,
+        ).run()
+        total = results['total']
+        self.assertGreater(total['requests'], 0)
+        self.assertEqual(total['errors'], 0)
+        self.assertLessEqual(total['p50'], total['p95'])
+        self.assertLessEqual(total['p95'], total['p99'])
+        self.assertEqual(total['concurrency'], 2)
+        self.assertLessEqual(
+            set(results['endpoints']),
+            set(['/', '/mean_time', '/start_end', '/api/v1/users',
+                 '/api/v1/presence_weekday/<user_id>',
+                 '/api/v1/mean_time_weekday/<user_id>',
+                 '/api/v1/presence_start_end/<user_id>'])
+        )
+        self.assertIn('/api/v1/users', results['endpoints'])
+        with mock.patch('sys.stdout', StringIO()) as output:
+            loadtest.report(results)
+        self.assertEqual(
+            len(output.getvalue().splitlines()),
+            len(results['endpoints']) + 2
+        )
+
+        results = loadtest.LoadTest(
+            'http://127.0.0.1:1', concurrency=1, duration=0.1
+        ).run()
+        self.assertGreater(results['total']['errors'], 0)
+
+    def test_sqlite_backend(self):
+        """
+        Test serving presence data imported into SQLite database.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        csv_path = os.path.join(tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, csv_path)
+        with open(csv_path, 'ab') as csvfile:
+            csvfile.write('\n')
+        main.app.config['DATA_CSV'] = csv_path
+        expected = {
+            'data': utils.get_data(),
+            'aggregates': utils.get_aggregates(),
+            'timeline': utils.get_timeline(),
+            'users_timeline': utils.get_users_timeline([10, 12]),
+            'users': utils.get_user_data(),
+            'version': utils.presence_version(),
+            'range': utils.get_range_aggregates(
+                10, datetime.date(2013, 9, 10), datetime.date(2013, 9, 11)
+            ),
+        }
+
+        db_path = os.path.join(tmpdir, 'presence.sqlite')
+        main.app.config.update(STORAGE_BACKEND='sqlite', DATABASE=db_path)
+        self.addCleanup(main.app.config.pop, 'STORAGE_BACKEND')
+        self.addCleanup(database.close, db_path)
+        utils.clear_cache()
+        aggregates = utils.get_aggregates()
+        self.assertIsInstance(aggregates, database.Aggregates)
+        self.assertEqual(dict(aggregates), expected['aggregates'])
+        self.assertEqual(dict(aggregates.items()), expected['aggregates'])
+        self.assertIn(10, aggregates)
+        self.assertNotIn(12, aggregates)
+        self.assertIsNone(aggregates.get(12))
+        self.assertEqual(len(aggregates), len(expected['aggregates']))
+        self.assertEqual(utils.get_data(), expected['data'])
+        self.assertIs(utils.get_data(), utils.get_data())
+        self.assertEqual(utils.get_timeline(), expected['timeline'])
+        self.assertEqual(
+            utils.get_users_timeline([10, 12]), expected['users_timeline']
+        )
+        self.assertNotEqual(utils.presence_version(), expected['version'])
+        self.assertEqual(utils.get_user_data(), expected['users'])
+        self.assertEqual(
+            utils.get_range_aggregates(
+                10, datetime.date(2013, 9, 10), datetime.date(2013, 9, 11)
+            ),
+            expected['range']
+        )
+        self.assertEqual(
+            utils.get_users_aggregates([10, 12]),
+            {10: expected['aggregates'][10]}
+        )
+        self.assertNotIn('load_presence', utils.CACHE)
+
+        # users are listed, counted and summed by one query each, not
+        # by queries per user
+        connection = mock.Mock(wraps=database.connect(db_path))
+        with mock.patch.object(database, 'connect', return_value=connection):
+            resp = main.app.test_client().get('/api/v1/stats?users=all')
+        self.assertEqual(connection.execute.call_count, 3)
+        self.assertEqual(
+            [user['user_id'] for user in json.loads(resp.data)],
+            sorted(expected['aggregates'])
+        )
+
+        connection = database.connect(db_path)
+        self.assertEqual(database.import_csv(connection, csv_path), 0)
+        self.assertEqual(database.import_users(connection, TEST_USERS_XML), 0)
+        with open(csv_path, 'ab') as csvfile:
+            csvfile.write('10,2013-09-12,09:00:00,17:00:00\n')
+        self.assertEqual(database.import_csv(connection, csv_path), 1)
+        self.assertEqual(
+            database.weekday_aggregates(connection, 10)[3],
+            [1, 28800, 32400, 61200]
+        )
+        with open(csv_path, 'wb') as csvfile:
+            csvfile.write('11,2013-09-12,09:00:00,10:00:00\n')
+        self.assertEqual(database.import_csv(connection, csv_path), 1)
+        self.assertEqual(list(database.Aggregates(db_path)), [11])
+        self.assertEqual(
+            database.import_csv(connection, csv_path, full=True), 1
+        )
+
+    def test_line_index(self):
+        """
+        Test reading lines of single user through CSV line index.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        csv_path = os.path.join(tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, csv_path)
+        with open(csv_path, 'ab') as csvfile:
+            csvfile.write('\n10,2013-09-13,09:00:00,17:00:00\n'
+                          '11,2013-09-16,09:00:00,10:00:00\n')
+        main.app.config['DATA_CSV'] = csv_path
+        data = utils.get_data()
+        expected = utils.get_aggregates()
+        first, last = datetime.date(2013, 9, 10), datetime.date(2013, 9, 11)
+        expected_range = utils.get_range_aggregates(10, first, last)
+        expected_timeline = utils.get_users_timeline([10, 12])
+        expected_totals = utils.get_timeline()
+
+        index_path = os.path.join(tmpdir, 'data.csv.idx')
+        self.assertEqual(lineindex.build(csv_path, index_path), 2)
+        index = lineindex.LineIndex(index_path)
+        self.addCleanup(index.close)
+        self.assertTrue(index.is_fresh(csv_path))
+        # appended lines are not adjacent to other lines of their users
+        self.assertEqual(len(index.ranges(10)), 2)
+        self.assertEqual(len(index.ranges(11)), 2)
+        self.assertEqual(index.ranges(12), [])
+        with open(csv_path, 'rb') as csvfile:
+            content = csvfile.read()
+        for offset, length in index.ranges(11):
+            self.assertTrue(content[offset:offset + length].startswith('11,'))
+
+        main.app.config['DATA_CSV_INDEX'] = index_path
+        self.addCleanup(main.app.config.pop, 'DATA_CSV_INDEX')
+        utils.clear_cache()
+        aggregates = utils.get_aggregates()
+        self.assertIsInstance(aggregates, lineindex.Aggregates)
+        # timeline is built by loader, not by request reading it
+        with mock.patch.object(lineindex.Aggregates, 'timeline') as timeline:
+            self.assertEqual(utils.get_timeline(), expected_totals)
+        self.assertFalse(timeline.called)
+        self.assertEqual(dict(aggregates), expected)
+        self.assertEqual(aggregates.user_data(11), data[11])
+        self.assertNotIn(12, aggregates)
+        self.assertEqual(
+            utils.get_range_aggregates(10, first, last), expected_range
+        )
+        self.assertEqual(
+            utils.get_users_timeline([10, 12]), expected_timeline
+        )
+        self.assertEqual(utils.get_timeline(), expected_totals)
+        self.assertNotIn('load_presence', utils.CACHE)
+
+        # parsed lines of recently requested users are kept
+        self.assertIs(aggregates[10], aggregates[10])
+        recent = lineindex.Aggregates(index, csv_path, max_users=1)
+        first_10 = recent[10]
+        self.assertIs(recent[10], first_10)
+        self.assertEqual(recent[11], expected[11])
+        self.assertIsNot(recent[10], first_10)
+        self.assertEqual(recent[10], first_10)
+
+        time.sleep(0.01)
+        with open(csv_path, 'ab') as csvfile:
+            csvfile.write('12,2013-09-12,09:00:00,10:00:00\n')
+        self.assertFalse(index.is_fresh(csv_path))
+        self.assertIn(12, utils.load_line_index()['aggregates'])
+        day = (
+            datetime.date(2013, 9, 12).toordinal() - expected_totals['first']
+        )
+        with mock.patch.object(lineindex.Aggregates, 'timeline') as timeline:
+            self.assertEqual(
+                utils.get_timeline()['daily_heads'][day],
+                expected_totals['daily_heads'][day] + 1
+            )
+        self.assertFalse(timeline.called)
+        self.assertEqual(
+            utils.get_aggregates()[12][3], [1, 3600, 32400, 36000]
+        )
+
+        with open(index_path, 'wb') as index_file:
+            index_file.write('broken')
+        with self.assertRaises(lineindex.LineIndexError):
+            lineindex.LineIndex(index_path)
+        self.assertEqual(
+            len(lineindex.open_index(csv_path, index_path).users), 3
+        )
+
 
 def suite():
     """
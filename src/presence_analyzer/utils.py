@@ -3,16 +3,663 @@
 Helper functions used in views.
 """
 
+import os
 import csv
+import threading
+from array import array
 
-from lxml import etree
-from datetime import datetime
+from datetime import date, datetime, time
+from time import sleep
+from functools import wraps
+from timeit import default_timer as timer
 from presence_analyzer.main import app
+from presence_analyzer import helpers
+from presence_analyzer import metrics
+from presence_analyzer import columnar
+from presence_analyzer import snapshot
 
 import logging
 log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
 
+CACHE = {}
+CACHE_STATS = {'hits': 0, 'misses': 0, 'reloads': 0, 'updates': 0}
+_stats_lock = threading.Lock()
 
+# loaders decorated with cached(), in definition order
+LOADERS = []
+REFRESHER = {'thread': None, 'stop': threading.Event()}
+# seconds spent in phases of last presence data load
+LOAD_TIMINGS = {}
+WARM_UP = {'timings': {}, 'done': threading.Event()}
+# longest pause in seconds between failed warm up attempts
+WARM_UP_MAX_DELAY = 60
+# processes parsing DATA_CSV, see start_workers
+WORKERS = {'pool': None}
+_refreshing = threading.local()
+_loaded_lock = threading.Lock()
+
+
+def file_version(path):
+    """
+    Returns tuple identifying current contents of given file.
+    """
+    stat = os.stat(path)
+    return (path, stat.st_mtime, stat.st_size)
+
+
+def _count(stat):
+    """
+    Increments given cache counter.
+    """
+    with _stats_lock:
+        CACHE_STATS[stat] += 1
+
+
+def data_version(*config_keys):
+    """
+    Returns version of file pointed by given setting, or tuple of versions
+    when more settings are given.
+    """
+    if len(config_keys) == 1:
+        return file_version(app.config[config_keys[0]])
+    return tuple(file_version(app.config[key]) for key in config_keys)
+
+
+def cached(*config_keys, **options):
+    """
+    Caches result of wrapped loader in memory.
+
+    Result is kept until any file pointed by `config_keys` settings changes
+    (path, mtime or size). Only one thread at a time reloads the data,
+    the others wait for it and share the freshly loaded result.
+
+    When file changes, optional `update(old_version, old_result, version)`
+    function may return result updated incrementally. If it returns None
+    the loader is called again.
+
+    While background refresher runs (see start_refresher) cached result is
+    served without checking files, the refresher reloads it. Optional
+    `enabled()` function tells refresher whether loader is in use.
+
+    Values of `settings` changing the loaded structure are part of the
+    cache key too, result is loaded again when any of them changes.
+    """
+    update = options.get('update')
+    enabled = options.get('enabled')
+    settings = options.get('settings', ())
+
+    def decorator(function):
+        name = function.__name__
+        lock = threading.Lock()
+
+        @wraps(function)
+        def inner():
+            entry = CACHE.get(name)
+            if (entry is not None and REFRESHER['thread'] is not None and
+                    not getattr(_refreshing, 'active', False)):
+                _count('hits')
+                return entry[1]
+            return load(data_version(*config_keys))
+
+        def load(version):
+            """
+            Returns result for given files version, loading it if needed.
+            """
+            config = tuple(app.config.get(key) for key in settings)
+            entry = CACHE.get(name)
+            if entry is not None and entry[::2] == (version, config):
+                _count('hits')
+                return entry[1]
+
+            with lock:
+                entry = CACHE.get(name)
+                if entry is not None and entry[::2] == (version, config):
+                    _count('hits')
+                    return entry[1]
+
+                result = None
+                if (entry is not None and update is not None and
+                        entry[2] == config):
+                    result = update(entry[0], entry[1], version)
+                if result is not None:
+                    _count('updates')
+                else:
+                    _count('misses' if entry is None else 'reloads')
+                    result = function()
+                # single assignment, readers see either old or new entry
+                CACHE[name] = (version, result, config)
+            return result
+
+        def refresh():
+            """
+            Reloads result if files changed and loader is in use.
+            """
+            if enabled is None or enabled():
+                load(data_version(*config_keys))
+
+        def version():
+            """
+            Returns (file versions, settings) of result served now, loading
+            it if needed. Result served afterwards is never older.
+            """
+            entry = CACHE.get(name)
+            if (entry is None or REFRESHER['thread'] is None or
+                    getattr(_refreshing, 'active', False)):
+                load(data_version(*config_keys))
+                entry = CACHE[name]
+            versions = entry[0] if len(config_keys) > 1 else (entry[0],)
+            return versions, entry[2]
+
+        inner.refresh = refresh
+        inner.version = version
+        LOADERS.append(inner)
+        return inner
+    return decorator
+
+
+def refresh():
+    """
+    Reloads cached data of all loaders whose files changed.
+    """
+    _refreshing.active = True
+    try:
+        for loader in LOADERS:
+            try:
+                loader.refresh()
+            except Exception:  # pylint: disable-msg=W0703
+                log.exception('Refreshing %s failed', loader.__name__)
+    finally:
+        _refreshing.active = False
+
+
+def _refresh_loop(interval):
+    """
+    Refreshes data every `interval` seconds until refresher is stopped.
+    """
+    stop = REFRESHER['stop']
+    while not stop.is_set():
+        refresh()
+        stop.wait(interval)
+
+
+def start_refresher(interval):
+    """
+    Starts background thread polling data files every `interval` seconds
+    and swapping freshly loaded data in, so requests never wait for
+    parsing once data is loaded.
+    """
+    if REFRESHER['thread'] is not None:
+        return
+    REFRESHER['stop'].clear()
+    thread = threading.Thread(
+        target=_refresh_loop, args=(interval,), name='data-refresher'
+    )
+    thread.daemon = True
+    REFRESHER['thread'] = thread
+    thread.start()
+    log.info('Refreshing data every %s seconds in background', interval)
+
+
+def warm_up():
+    """
+    Loads all cached data and its indexes.
+
+    Returns seconds spent in each phase, also kept in WARM_UP['timings'].
+    """
+    LOAD_TIMINGS.clear()
+    timings = {}
+    if use_database():
+        data_loader = load_database
+    elif use_line_index():
+        data_loader = load_line_index
+    else:
+        data_loader = load_presence
+    loaders = (data_loader, get_user_data, get_users_json)
+    for loader in loaders:
+        started = timer()
+        loader()
+        timings[loader.__name__] = timer() - started
+    if data_loader is load_presence:
+        indexes = dict(
+            (phase, seconds) for phase, seconds in LOAD_TIMINGS.items()
+            if phase != 'presence'
+        )
+        timings.update(('load_presence.' + phase, seconds)
+                       for phase, seconds in indexes.items())
+        timings['load_presence.parse'] = (
+            LOAD_TIMINGS.get('presence', 0) - sum(indexes.values())
+        )
+    WARM_UP['timings'] = timings
+    WARM_UP['done'].set()
+    log.info(
+        'Warmed up in %.3fs: %s',
+        sum(timings[loader.__name__] for loader in loaders),
+        ', '.join('{0}={1:.3f}s'.format(phase, seconds)
+                  for phase, seconds in sorted(timings.items()))
+    )
+    return timings
+
+
+def start_warm_up(interval=None):
+    """
+    Warms up caches in background thread, see is_ready. Refresher polling
+    data files every `interval` seconds is started once data is loaded.
+    """
+    WARM_UP['done'].clear()
+    thread = threading.Thread(
+        target=_warm_up_safely, args=(interval,), name='warm-up'
+    )
+    thread.daemon = True
+    thread.start()
+
+
+def _warm_up_safely(interval=None, delay=1.0):
+    """
+    Runs warm_up until it succeeds, then starts refresher, see start_warm_up.
+
+    Failed attempt is retried after `delay` seconds, the delay doubles after
+    each failure up to WARM_UP_MAX_DELAY.
+    """
+    while True:
+        try:
+            warm_up()
+        except Exception:  # pylint: disable-msg=W0703
+            log.exception('Warm up failed, retrying in %s seconds', delay)
+            sleep(delay)
+            delay = min(delay * 2, WARM_UP_MAX_DELAY)
+        else:
+            break
+    if interval:
+        start_refresher(interval)
+
+
+def is_ready():
+    """
+    Checks whether worker is ready to serve traffic: data is warmed up,
+    or warming up is disabled by PREWARM setting.
+    """
+    return not app.config.get('PREWARM') or WARM_UP['done'].is_set()
+
+
+def stop_refresher():
+    """
+    Stops background refresher thread.
+    """
+    thread = REFRESHER['thread']
+    if thread is None:
+        return
+    REFRESHER['stop'].set()
+    thread.join()
+    REFRESHER['thread'] = None
+
+
+def start_workers(count):
+    """
+    Starts `count` processes parsing DATA_CSV when loading presence data.
+
+    Has to be called before any thread starts, children of multi-threaded
+    process may deadlock on locks held by other threads while forking.
+    Without started processes DATA_CSV is parsed by the serving process.
+    """
+    import multiprocessing
+    if WORKERS['pool'] is None and count > 1:
+        WORKERS['pool'] = multiprocessing.Pool(count)
+
+
+def stop_workers():
+    """
+    Stops processes parsing DATA_CSV.
+    """
+    pool = WORKERS['pool']
+    if pool is None:
+        return
+    pool.close()
+    pool.join()
+    WORKERS['pool'] = None
+
+
+def cache_stats():
+    """
+    Returns copy of cache counters.
+    """
+    with _stats_lock:
+        return dict(CACHE_STATS)
+
+
+def clear_cache():
+    """
+    Drops all cached data and resets counters.
+    """
+    with _stats_lock:
+        CACHE.clear()
+        for stat in CACHE_STATS:
+            CACHE_STATS[stat] = 0
+
+
+def update_presence(old_version, presence, version):
+    """
+    Merges rows appended to DATA_CSV file into loaded presence data.
+
+    Returns None, so the file is loaded again, when it was truncated or
+    rewritten, or when presence data does not come from plain CSV loading.
+    Loaded structures are copied, not modified in place. Unterminated last
+    line is merged only after it is finished.
+    """
+    path = version[0]
+    offset = presence.get('offset')
+    tail = presence.get('tail', '')
+    if path != old_version[0] or offset is None or version[2] < offset:
+        return None
+
+    with open(path, 'rb') as csvfile:
+        csvfile.seek(offset - len(tail))
+        if csvfile.read(len(tail)) != tail:
+            return None
+        state = {'offset': offset, 'tail': tail}
+        rows = list(iter_rows(track_lines(csvfile, state)))
+
+    data = dict(presence['data'])
+    aggregates = dict(presence['aggregates'])
+    for user_id in set(row[0] for row in rows):
+        data[user_id] = dict(data.get(user_id, {}))
+        aggregates[user_id] = [
+            list(weekday)
+            for weekday in aggregates.get(user_id, [[0, 0, 0, 0]] * 7)
+        ]
+
+    changes = []
+    for user_id, day, start, end in rows:
+        user_data = data[user_id]
+        weekday = aggregates[user_id][day.weekday()]
+        if day in user_data:
+            old_start = user_data[day]['start']
+            old_end = user_data[day]['end']
+            helpers.add_to_aggregate(weekday, old_start, old_end, -1)
+            changes.append((
+                day.toordinal(), -helpers.interval(old_start, old_end), -1
+            ))
+        helpers.add_to_aggregate(weekday, start, end)
+        changes.append((day.toordinal(), helpers.interval(start, end), 1))
+        user_data[day] = {
+            'start': start,
+            'end': end
+        }
+
+    date_index = dict(presence['date_index'])
+    for user_id in set(row[0] for row in rows):
+        date_index[user_id] = helpers.date_index(data[user_id])
+
+    log.debug('Merged %d appended rows', len(rows))
+    return dict(
+        presence,
+        data=data,
+        aggregates=aggregates,
+        date_index=date_index,
+        timeline=helpers.timeline(changes, presence['timeline']),
+        **state
+    )
+
+
+def track_lines(lines, state, unfinished=False):
+    """
+    Passes complete lines through, remembering offset and text of last one.
+
+    Unterminated last line is left to be read next time, with `unfinished`
+    it is passed through too (but still read again next time).
+    """
+    for line in lines:
+        if line.endswith('\n'):
+            state['offset'] += len(line)
+            state['tail'] = line
+        elif not unfinished:
+            break
+        yield line
+
+
+def use_database():
+    """
+    Checks whether data is served from SQLite database, see database.
+    """
+    return app.config.get('STORAGE_BACKEND') == 'sqlite'
+
+
+@metrics.timed('load')
+@cached('DATA_CSV', 'USERS_XML', settings=('DATABASE',),
+        enabled=use_database)
+def load_database():
+    """
+    Imports rows appended to DATA_CSV and changed USERS_XML into DATABASE.
+
+    Returns aggregates mapping querying database and timeline.
+    """
+    from presence_analyzer import database
+    path = app.config['DATABASE']
+    connection = database.connect(path)
+    rows = database.import_csv(connection, app.config['DATA_CSV'])
+    users = database.import_users(connection, app.config['USERS_XML'])
+    log.debug('Imported %d rows and %d users into %s', rows, users, path)
+    return {
+        'aggregates': database.Aggregates(path),
+        'timeline': database.timeline(connection),
+    }
+
+
+def use_line_index():
+    """
+    Checks whether chart data is read from DATA_CSV lines of single user
+    found through DATA_CSV_INDEX file, see lineindex.
+    """
+    return bool(app.config.get('DATA_CSV_INDEX')) and not use_database()
+
+
+@metrics.timed('load')
+@cached('DATA_CSV', enabled=use_line_index)
+def load_line_index():
+    """
+    Opens per-user index of DATA_CSV lines, rebuilding it when CSV changed.
+
+    Returns aggregates mapping parsing lines of requested user only,
+    together with company-wide timeline, built here so requests never
+    read the whole file.
+    """
+    from presence_analyzer import lineindex
+    source = app.config['DATA_CSV']
+    index = lineindex.open_index(source, app.config['DATA_CSV_INDEX'])
+    aggregates = lineindex.Aggregates(
+        index, source, app.config.get('DATA_CSV_INDEX_CACHE_USERS', 256)
+    )
+    return {
+        'aggregates': aggregates,
+        'timeline': _timed('timeline', aggregates.timeline),
+    }
+
+
+@metrics.timed('load')
+def presence_version():
+    """
+    Returns version of presence data served by views now, see cached.
+    Storage backend serving the data is added to its settings.
+    """
+    if use_database():
+        backend, loader = 'sqlite', load_database
+    elif use_line_index():
+        backend, loader = 'line_index', load_line_index
+    else:
+        backend, loader = 'csv', load_presence
+    versions, settings = loader.version()
+    return versions, (backend,) + settings
+
+
+@metrics.timed('load')
+def users_version():
+    """
+    Returns version of users listing served by views now, see cached.
+    """
+    return get_users_json.version()
+
+
+def _connect():
+    """
+    Returns current thread's connection to up to date database.
+    """
+    from presence_analyzer import database
+    load_database()
+    return database.connect(app.config['DATABASE'])
+
+
+@metrics.timed('load')
+@cached('DATA_CSV', update=update_presence, settings=('PRESENCE_STORE',),
+        enabled=lambda: not use_database() and not use_line_index())
+def load_presence():
+    """
+    Loads presence data together with indexes derived from it.
+
+    Returned structure depends on PRESENCE_STORE setting, for 'dict' store:
+
+    presence = {
+        'data': <get_data() structure>,
+        'aggregates': <build_aggregates() structure>,
+        'date_index': <build_date_index() structure>,
+        'timeline': <helpers.timeline() structure>,
+    }
+
+    and for 'columnar' store 'data' and 'date_index' are replaced with
+    'columns' holding columnar.ColumnarStore instance, 'data' is added
+    by first get_data() call.
+
+    Data comes from DATA_SNAPSHOT file when it is up to date with DATA_CSV.
+    Data loaded from CSV file into 'dict' store also keeps 'offset' and
+    'tail' of the consumed part of the file, see update_presence.
+    """
+    started = timer()
+    presence = _read_presence()
+    LOAD_TIMINGS['presence'] = timer() - started
+    return presence
+
+
+def _read_presence():
+    """
+    Reads presence data and builds its indexes, see load_presence.
+    """
+    store = app.config.get('PRESENCE_STORE', 'dict')
+    presence_snapshot = open_snapshot()
+    if presence_snapshot is not None:
+        if store == 'columnar':
+            # columns view mapped memory, snapshot has to stay open
+            return _index_columns(presence_snapshot.to_columns())
+        data = presence_snapshot.to_data()
+        presence_snapshot.close()
+        return _index_data(data)
+
+    path = app.config['DATA_CSV']
+    workers = app.config.get('DATA_CSV_WORKERS', 1)
+    if workers > 1 and WORKERS['pool'] is not None:
+        size = os.path.getsize(path)
+        columns = read_columns_parallel(path, workers, size, WORKERS['pool'])
+        if store == 'columnar':
+            return _index_columns(columnar.ColumnarStore(*columns))
+        return dict(_index_data(columns_to_data(*columns)),
+                    **_line_state(path, size))
+
+    with open(path, 'rb') as csvfile:
+        if store == 'columnar':
+            return _index_columns(
+                columnar.ColumnarStore.from_rows(iter_rows(csvfile))
+            )
+        state = {'offset': 0, 'tail': ''}
+        data = read_data(track_lines(csvfile, state, unfinished=True))
+    return dict(_index_data(data), **state)
+
+
+def _line_state(path, size):
+    """
+    Returns offset and text of last complete line within first `size`
+    bytes of file, as kept by track_lines.
+    """
+    with open(path, 'rb') as csvfile:
+        start = max(size - 4096, 0)
+        csvfile.seek(start)
+        content = csvfile.read(size - start)
+    end = content.rfind('\n') + 1
+    if end == 0:
+        # no complete line in the last block, disable tail loading
+        return {'offset': 0 if start == 0 else None, 'tail': ''}
+    line_start = content.rfind('\n', 0, end - 1) + 1
+    if line_start == 0 and start > 0:
+        return {'offset': None, 'tail': ''}
+    return {'offset': start + end, 'tail': content[line_start:end]}
+
+
+def _index_data(data):
+    """
+    Builds presence structure of 'dict' store, see load_presence.
+    """
+    return {
+        'data': data,
+        'aggregates': _timed('aggregates', build_aggregates, data),
+        'date_index': _timed('date_index', build_date_index, data),
+        'timeline': _timed('timeline', build_timeline, data),
+    }
+
+
+def _index_columns(columns):
+    """
+    Builds presence structure of 'columnar' store, see load_presence.
+    """
+    return {
+        'columns': columns,
+        'aggregates': _timed('aggregates', columns.aggregates),
+        'timeline': _timed('timeline', build_columns_timeline, columns),
+    }
+
+
+def _timed(phase, function, *args):
+    """
+    Calls function recording its duration in LOAD_TIMINGS.
+    """
+    started = timer()
+    result = function(*args)
+    LOAD_TIMINGS[phase] = timer() - started
+    return result
+
+
+def open_snapshot():
+    """
+    Opens DATA_SNAPSHOT file if it is configured and fresh.
+
+    Returns None when CSV file has to be used instead.
+    """
+    path = app.config.get('DATA_SNAPSHOT')
+    if not path or not os.path.exists(path):
+        return None
+
+    try:
+        presence_snapshot = snapshot.Snapshot(path)
+    except snapshot.SnapshotError:
+        log.warning('Ignoring broken snapshot %s', path, exc_info=True)
+        return None
+
+    if not presence_snapshot.is_fresh(app.config['DATA_CSV']):
+        log.info('Snapshot %s is stale, loading CSV', path)
+        presence_snapshot.close()
+        return None
+    return presence_snapshot
+
+
+def build_snapshot(path=None):
+    """
+    Writes binary snapshot of DATA_CSV file to DATA_SNAPSHOT or given path.
+
+    Returns number of written records.
+    """
+    source = app.config['DATA_CSV']
+    info = snapshot.source_info(source)
+    with open(source, 'rb') as csvfile:
+        data = read_data(csvfile)
+    return snapshot.write(path or app.config['DATA_SNAPSHOT'], data, info)
+
+
+@metrics.timed('load')
 def get_data():
     """
     Extracts presence data from CSV file and groups it by user_id.
@@ -30,32 +677,420 @@ def get_data():
             },
         }
     }
+
+    Parsed data is cached until the CSV file changes. With 'columnar'
+    PRESENCE_STORE or 'sqlite' STORAGE_BACKEND the structure is built
+    on first call and kept with the cached data.
+    """
+    if use_database():
+        from presence_analyzer import database
+        loaded = load_database()
+        connection = database.connect(app.config['DATABASE'])
+        return _loaded(
+            loaded, 'data', lambda: database.to_data(connection)
+        )
+    presence = load_presence()
+    if 'columns' in presence:
+        return _loaded(presence, 'data', presence['columns'].to_data)
+    return presence['data']
+
+
+def _loaded(loaded, key, build):
+    """
+    Returns `key` item of cached `loaded` dict, building it with `build`
+    on first use.
+    """
+    value = loaded.get(key)
+    if value is None:
+        with _loaded_lock:
+            value = loaded.get(key)
+            if value is None:
+                value = loaded[key] = build()
+    return value
+
+
+@metrics.timed('load')
+def get_aggregates():
+    """
+    Returns per user weekday aggregates of presence data.
+    """
+    if use_database():
+        return load_database()['aggregates']
+    if use_line_index():
+        return load_line_index()['aggregates']
+    return load_presence()['aggregates']
+
+
+def get_users_aggregates(user_ids):
+    """
+    Returns {user_id: weekday aggregates} of given users, unknown users
+    are skipped. SQLite store sums all users by single query.
+    """
+    aggregates = get_aggregates()
+    user_ids = set(user_ids)
+    if use_database():
+        return _aggregate(lambda: dict(
+            (user_id, weekdays)
+            for user_id, weekdays in aggregates.iteritems()
+            if user_id in user_ids
+        ))
+    return dict(
+        (user_id, aggregates[user_id])
+        for user_id in user_ids if user_id in aggregates
+    )
+
+
+def get_range_aggregates(user_id, first=None, last=None):
+    """
+    Returns weekday aggregates of given user limited to dates between
+    first and last (inclusive). Missing bound means no limit.
+
+    Loading data and aggregating it are timed as separate phases.
+    """
+    if use_database():
+        from presence_analyzer import database
+        return _aggregate(
+            database.weekday_aggregates, _connect(), user_id, first, last
+        )
+    if use_line_index():
+        index = _load(load_line_index()['aggregates'].date_index, user_id)
+        return helpers.range_aggregates(index, first, last)
+    presence = load_presence()
+    if 'columns' in presence:
+        return _aggregate(
+            presence['columns'].weekday_aggregates, user_id, first, last
+        )
+    index = presence['date_index'].get(user_id)
+    if index is None:
+        return [[0, 0, 0, 0] for _ in range(7)]
+    return helpers.range_aggregates(index, first, last)
+
+
+@metrics.timed('load')
+def _load(function, *args):
+    """
+    Calls function reading presence data, timed as 'load' phase.
+    """
+    return function(*args)
+
+
+@metrics.timed('aggregate')
+def _aggregate(function, *args):
+    """
+    Calls function summing presence data, timed as 'aggregate' phase.
+    """
+    return function(*args)
+
+
+@metrics.timed('load')
+def get_timeline():
+    """
+    Returns company-wide timeline of daily presence, see helpers.timeline.
+    """
+    if use_database():
+        return load_database()['timeline']
+    if use_line_index():
+        return load_line_index()['timeline']
+    return load_presence()['timeline']
+
+
+def get_users_timeline(user_ids):
+    """
+    Returns timeline of daily presence of given users only, see
+    helpers.timeline. Unknown users are skipped.
+    """
+    user_ids = set(user_ids)
+    if use_database():
+        from presence_analyzer import database
+        return _aggregate(database.timeline, _connect(), user_ids)
+    if use_line_index():
+        aggregates = load_line_index()['aggregates']
+        data = dict(
+            (user_id, _load(aggregates.user_data, user_id))
+            for user_id in user_ids if user_id in aggregates
+        )
+        return _aggregate(build_timeline, data)
+    presence = load_presence()
+    if 'columns' in presence:
+        return _aggregate(
+            build_columns_timeline, presence['columns'], user_ids
+        )
+    data = presence['data']
+    return _aggregate(build_timeline, dict(
+        (user_id, data[user_id]) for user_id in user_ids if user_id in data
+    ))
+
+
+def build_timeline(data):
+    """
+    Builds company-wide timeline of daily presence from get_data() structure.
+    """
+    return helpers.timeline(
+        (
+            day.toordinal(),
+            helpers.interval(start_end['start'], start_end['end']),
+            1,
+        )
+        for items in data.itervalues()
+        for day, start_end in items.iteritems()
+    )
+
+
+def build_columns_timeline(columns, user_ids=None):
+    """
+    Builds company-wide timeline of daily presence, or timeline of given
+    users, from columnar.ColumnarStore.
+    """
+    if user_ids is None:
+        rows = [slice(None)]
+    else:
+        rows = [columns.user_slice(user_id) for user_id in user_ids]
+    return helpers.timeline(
+        change
+        for row in rows
+        for change in zip(
+            columns.days[row].tolist(),
+            (columns.ends[row] - columns.starts[row]).tolist(),
+            [1] * len(columns.days[row]),
+        )
+    )
+
+
+def build_date_index(data):
+    """
+    Builds per user date index for date range queries.
+
+    Returned data structure:
+
+    date_index = {
+        'user_id': <helpers.date_index() structure>,
+        ...
+    }
+    """
+    return {
+        user_id: helpers.date_index(items)
+        for user_id, items in data.iteritems()
+    }
+
+
+def build_aggregates(data):
+    """
+    Precomputes weekday aggregates for every user.
+
+    Returned data structure:
+
+    aggregates = {
+        'user_id': [
+            [<count>, <total>, <sum of starts>, <sum of ends>],  # Monday
+            ...
+            [<count>, <total>, <sum of starts>, <sum of ends>],  # Sunday
+        ],
+        ...
+    }
+    """
+    return {
+        user_id: helpers.weekday_aggregates(items)
+        for user_id, items in data.iteritems()
+    }
+
+
+def read_data(csvfile, parse=None):
+    """
+    Reads presence rows from opened CSV file into get_data() structure.
+
+    Rows are converted with `parse` function, `parse_row` by default.
     """
     data = {}
-    with open(app.config['DATA_CSV'], 'rb') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
+    for user_id, day, start, end in iter_rows(csvfile, parse):
+        user_data = data.setdefault(user_id, {})
+        user_data[day] = {
+            'start': start,
+            'end': end
+        }
 
-            try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-
-                user_data = data.setdefault(user_id, {})
-                user_data[date] = {
-                    'start': start,
-                    'end': end
-                }
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
+    return data
+
+
+def iter_rows(csvfile, parse=None):
+    """
+    Yields (user_id, date, start, end) tuples from opened CSV file.
+
+    Header, footer and malformed lines are skipped.
+    """
+    parse = parse or parse_row
+    presence_reader = csv.reader(csvfile, delimiter=',')
+    for i, row in enumerate(presence_reader):
+        if len(row) != 4:
+            # ignore header and footer lines
+            continue
+
+        try:
+            yield parse(row)
+        except (ValueError, TypeError):
+            log.debug('Problem with line %d: ', i, exc_info=True)
+
+
+def parse_row(row):
+    """
+    Converts CSV row into (user_id, date, start, end) tuple.
+
+    Well formed `YYYY-MM-DD` and `HH:MM:SS` fields are converted by slicing,
+    anything else goes through strict `parse_row_strict`.
+    """
+    user_id, day, start, end = row
+    if (len(day) == 10 and len(start) == 8 and len(end) == 8 and
+            day[4] == day[7] == '-' and
+            start[2] == start[5] == end[2] == end[5] == ':' and
+            (day[:4] + day[5:7] + day[8:] +
+             start[:2] + start[3:5] + start[6:] +
+             end[:2] + end[3:5] + end[6:]).isdigit()):
+        try:
+            return (
+                int(user_id),
+                date(int(day[:4]), int(day[5:7]), int(day[8:])),
+                time(int(start[:2]), int(start[3:5]), int(start[6:])),
+                time(int(end[:2]), int(end[3:5]), int(end[6:])),
+            )
+        except ValueError:
+            pass
+    return parse_row_strict(row)
+
+
+def parse_row_strict(row):
+    """
+    Converts CSV row into (user_id, date, start, end) tuple with strptime.
+    """
+    return (
+        int(row[0]),
+        datetime.strptime(row[1], '%Y-%m-%d').date(),
+        datetime.strptime(row[2], '%H:%M:%S').time(),
+        datetime.strptime(row[3], '%H:%M:%S').time(),
+    )
+
+
+def read_columns_parallel(path, workers, size=None, pool=None):
+    """
+    Parses CSV file in `workers` processes.
+
+    File is split into byte ranges aligned on line boundaries, each parsed
+    by separate process. Returns (user_ids, days, starts, ends) arrays
+    in file order, so later rows still override earlier ones.
+
+    Processes of given `pool` are used, without it they are started for
+    this call only, which is safe in single-threaded scripts only.
+    """
+    import multiprocessing
+    size = os.path.getsize(path) if size is None else size
+    chunks = [
+        (path, start, end) for start, end in _chunks(path, workers, size)
+    ]
+    if pool is not None:
+        chunks = pool.map(_parse_chunk, chunks)
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            chunks = pool.map(_parse_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
 
+    columns = tuple(array('i') for _ in range(4))
+    for chunk in chunks:
+        for column, values in zip(columns, chunk):
+            column.extend(values)
+    return columns
+
+
+def _chunks(path, count, size):
+    """
+    Splits first `size` bytes of file into at most `count` (start, end)
+    ranges, each ending right after a newline (or at `size`).
+    """
+    bounds = [0]
+    with open(path, 'rb') as csvfile:
+        for i in range(1, count):
+            position = max(size * i // count, bounds[-1])
+            csvfile.seek(position)
+            if position > 0:
+                csvfile.readline()
+            bounds.append(min(csvfile.tell(), size))
+    bounds.append(size)
+    return [
+        (start, end) for start, end in zip(bounds, bounds[1:]) if end > start
+    ]
+
+
+def _parse_chunk(args):
+    """
+    Parses byte range of CSV file into (user_ids, days, starts, ends)
+    arrays of ints. Runs in worker process.
+    """
+    path, start, end = args
+    with open(path, 'rb') as csvfile:
+        csvfile.seek(start)
+        lines = csvfile.read(end - start).splitlines()
+
+    columns = tuple(array('i') for _ in range(4))
+    user_ids, days, starts, ends = columns
+    for user_id, day, start_time, end_time in iter_rows(lines):
+        user_ids.append(user_id)
+        days.append(day.toordinal())
+        starts.append(helpers.seconds_since_midnight(start_time))
+        ends.append(helpers.seconds_since_midnight(end_time))
+    return columns
+
+
+def columns_to_data(user_ids, days, starts, ends):
+    """
+    Builds get_data() structure from parallel arrays of ints.
+
+    Equal dates and times share objects.
+    """
+    dates = {}
+    times = {}
+    data = {}
+    for user_id, day, start, end in zip(user_ids, days, starts, ends):
+        if day not in dates:
+            dates[day] = date.fromordinal(day)
+        for value in (start, end):
+            if value not in times:
+                times[value] = time(value // 3600, value // 60 % 60,
+                                    value % 60)
+        data.setdefault(user_id, {})[dates[day]] = {
+            'start': times[start],
+            'end': times[end],
+        }
     return data
 
 
+@metrics.timed('load')
+@cached('DATA_CSV', 'USERS_XML', settings=('STORAGE_BACKEND',))
+def get_users_json():
+    """
+    Returns users listing for dropdown, serialized to JSON.
+
+    Only users having presence data are listed:
+
+    [
+        {'user_id': <user_id>, 'name': <name>, 'avatar': <avatar_url>},
+        ...
+    ]
+    """
+    aggregates = get_aggregates()
+    users_info = get_user_data()
+    return helpers.Serialized(helpers.dumps([
+        {
+            'user_id': user_id,
+            'name': user_data['name'],
+            'avatar': user_data['avatar']
+        }
+        for user_id, user_data in users_info.iteritems()
+        if user_id in aggregates
+    ]))
+
+
+@metrics.timed('load')
+@cached('USERS_XML', settings=('STORAGE_BACKEND',))
 def get_user_data():
     """
     avatar: https://intranet.stxnext.pl/api/images/users/141
@@ -71,25 +1106,61 @@ def get_user_data():
     }
 
     """
-
-    user_data = {}
+    if use_database():
+        from presence_analyzer import database
+        return database.users(_connect())
     with open(app.config['USERS_XML'], 'rb') as xmlfile:
-        parser = etree.parse(xmlfile)
-        root = parser.getroot()
-        host = root.find('server/host').text
-        protocol = root.find('server/protocol').text
-        for element in root.find('users').iterchildren():
-            user_id = int(element.get('id'))
-            user_avatar = element.find('avatar').text
-            user_name = element.find('name').text
-
-            user_data[user_id] = {
-                'avatar': '{0}://{1}{2}'.format(
-                    protocol,
-                    host,
-                    user_avatar
-                ),
-                'name': user_name
-            }
-
-    return user_data
+        return dict(iter_user_data(xmlfile))
+
+
+def iter_user_data(xmlfile):
+    """
+    Yields (user_id, {'name': <name>, 'avatar': <avatar_url>}) pairs
+    parsed incrementally from users XML file.
+
+    Parsed elements are dropped as soon as they are consumed, so memory use
+    does not grow with file size. Users listed before server header are
+    held back until host and protocol are known.
+    """
+    from lxml import etree
+    server = {}
+    pending = []
+    elements = etree.iterparse(
+        xmlfile, events=('end',), tag=('host', 'protocol', 'user')
+    )
+    for _, element in elements:
+        if element.tag != 'user':
+            if element.getparent().tag == 'server':
+                server[element.tag] = element.text
+            continue
+
+        pending.append((
+            int(element.get('id')),
+            element.findtext('avatar'),
+            element.findtext('name'),
+        ))
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+        if len(server) == 2:
+            for user in pending:
+                yield _user_record(server, *user)
+            pending = []
+
+    for user in pending:
+        yield _user_record(server, *user)
+
+
+def _user_record(server, user_id, avatar, name):
+    """
+    Builds (user_id, user data) pair of get_user_data() structure.
+    """
+    return user_id, {
+        'avatar': '{0}://{1}{2}'.format(
+            server['protocol'],
+            server['host'],
+            avatar
+        ),
+        'name': name
+    }
@@ -3,13 +3,16 @@
 Defines views.
 """
 
-import calendar
+from datetime import date, datetime
 from flask import abort
+from flask import request
+from flask import Response
 from flask import render_template
 
 from presence_analyzer.main import app
 from presence_analyzer import utils
 from presence_analyzer import helpers
+from presence_analyzer import metrics
 
 
 import logging
@@ -41,78 +44,211 @@ def start_end_page():
 
 
 @app.route('/api/v1/users', methods=['GET'])
+@helpers.conditional(utils.users_version)
 @helpers.jsonify
 def users_view():
     """
     Users listing for dropdown.
     """
-    data = utils.get_data()
-    users_info = utils.get_user_data()
+    return utils.get_users_json()
 
-    return_data = [
-        {
-            'user_id': user_id,
-            'name': user_data['name'],
-            'avatar': user_data['avatar']
-        }
-        for user_id, user_data in users_info.iteritems() if user_id in data
-    ]
 
-    return return_data
+def date_range():
+    """
+    Returns (first, last) dates given as `from` and `to` query parameters
+    in YYYY-MM-DD format. Missing parameter gives None, `from` after `to`
+    aborts.
+    """
+    result = []
+    for name in ('from', 'to'):
+        value = request.args.get(name)
+        if value:
+            try:
+                value = datetime.strptime(value, '%Y-%m-%d').date()
+            except ValueError:
+                abort(400, 'Invalid {0} date {1!r}'.format(name, value))
+        result.append(value or None)
+    first, last = result
+    if first is not None and last is not None and first > last:
+        abort(400, 'Date range from {0} to {1} is empty'.format(first, last))
+    return first, last
+
+
+def requested_users(all_users):
+    """
+    Returns user ids given as comma separated `users` query parameter,
+    sorted `all_users` for 'all' or None when parameter is missing.
+    Aborts for empty or malformed list.
+    """
+    users = request.args.get('users')
+    if users is None:
+        return None
+    if users == 'all':
+        return sorted(all_users)
+    try:
+        return [int(user_id) for user_id in users.split(',')]
+    except ValueError:
+        abort(400, 'Invalid users list {!r}'.format(users))
+
+
+def user_aggregates(user_id, aggregates=None):
+    """
+    Returns weekday aggregates of given user limited to requested date
+    range. Aborts for unknown user.
+    """
+    if aggregates is None:
+        aggregates = utils.get_aggregates()
+    if user_id not in aggregates:
+        abort(401, 'User {} not found!'.format(user_id))
+
+    first, last = date_range()
+    if first is None and last is None:
+        return aggregates[user_id]
+    return utils.get_range_aggregates(user_id, first, last)
 
 
 @app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
+@helpers.conditional(utils.presence_version)
 @helpers.jsonify
+@helpers.memoize(utils.presence_version)
 def mean_time_weekday_view(user_id):
     """
     Returns mean presence time of given user grouped by weekday.
     """
-    data = utils.get_data()
-    if user_id not in data:
-        abort(401, 'User {} not found!'.format(user_id))
-
-    weekdays = helpers.group_by_weekday(data[user_id])
-    result = [(calendar.day_abbr[weekday], helpers.mean(intervals))
-              for weekday, intervals in weekdays.items()]
-
-    return result
+    return helpers.mean_time_weekday(user_aggregates(user_id))
 
 
 @app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
+@helpers.conditional(utils.presence_version)
 @helpers.jsonify
+@helpers.memoize(utils.presence_version)
 def presence_weekday_view(user_id):
     """
     Returns total presence time of given user grouped by weekday.
     """
-    data = utils.get_data()
-    if user_id not in data:
-        abort(401, 'User {} not found!'.format(user_id))
-
-    weekdays = helpers.group_by_weekday(data[user_id])
-    result = [(calendar.day_abbr[weekday], sum(intervals))
-              for weekday, intervals in weekdays.items()]
-
-    result.insert(0, ('Weekday', 'Presence (s)'))
-    return result
+    return helpers.presence_weekday(user_aggregates(user_id))
 
 
 @app.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
+@helpers.conditional(utils.presence_version)
 @helpers.jsonify
+@helpers.memoize(utils.presence_version)
 def presence_start_end_view(user_id):
     """
     Returns mean arrival and departure time for each weekday.
     """
-    data = utils.get_data()
-    if user_id not in data:
-        abort(401, 'User {} not found!'.format(user_id))
+    return helpers.presence_start_end(user_aggregates(user_id))
+
+
+@app.route('/api/v1/stats', methods=['GET'])
+@helpers.conditional(utils.presence_version)
+@helpers.jsonify
+@helpers.memoize(utils.presence_version)
+def stats_view():
+    """
+    Returns all chart statistics for users given as comma separated
+    `users` query parameter, or for every user when it is 'all'.
 
-    weekdays = helpers.group_start_end_times_by_weekday(data[user_id])
-    result = [
-        (
-            calendar.day_abbr[weekday], helpers.mean(intervals['start']),
-            helpers.mean(intervals['end'])
+    Unknown users are skipped. Optional `from` and `to` parameters limit
+    statistics to given date range.
+    """
+    aggregates = utils.get_aggregates()
+    user_ids = requested_users(aggregates) or []
+    first, last = date_range()
+    if first is None and last is None:
+        found = utils.get_users_aggregates(user_ids)
+    else:
+        found = dict(
+            (user_id, utils.get_range_aggregates(user_id, first, last))
+            for user_id in user_ids if user_id in aggregates
         )
-        for weekday, intervals in weekdays.iteritems()
-    ]
 
+    result = []
+    for user_id in user_ids:
+        weekdays = found.get(user_id)
+        if weekdays is None:
+            continue
+        result.append({
+            'user_id': user_id,
+            'mean_time_weekday': helpers.mean_time_weekday(weekdays),
+            'presence_weekday': helpers.presence_weekday(weekdays),
+            'presence_start_end': helpers.presence_start_end(weekdays),
+        })
     return result
+
+
+@app.route('/api/v1/presence_totals', methods=['GET'])
+@helpers.conditional(utils.presence_version)
+@helpers.jsonify
+@helpers.memoize(utils.presence_version)
+def presence_totals_view():
+    """
+    Returns company-wide presence totals and headcounts per `period`
+    ('daily', 'weekly' or 'monthly') between optional `from` and `to` dates.
+
+    Optional comma separated `users` parameter limits totals to given users.
+    Headcount of periods longer than a day counts user-days. Dates are
+    clipped to the ones having presence data.
+    """
+    period = request.args.get('period', 'daily')
+    if period not in ('daily', 'weekly', 'monthly'):
+        abort(400, 'Invalid period {!r}'.format(period))
+
+    timeline = utils.get_timeline()
+    first, last = date_range()
+    if timeline['first'] is None:
+        return []
+    # periods without data are not listed
+    first = max(first or date.min, date.fromordinal(timeline['first']))
+    last = min(last or date.max, date.fromordinal(
+        timeline['first'] + len(timeline['daily_totals']) - 1
+    ))
+
+    user_ids = requested_users(utils.get_aggregates())
+    if user_ids is not None:
+        timeline = utils.get_users_timeline(user_ids)
+    result = []
+    for start, end in helpers.periods(first, last, period):
+        total, headcount = helpers.timeline_range(timeline, start, end)
+        result.append({
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'total': total,
+            'headcount': headcount,
+        })
+    return result
+
+
+@app.route('/ready', methods=['GET'])
+def ready_view():
+    """
+    Readiness check for load balancer, 503 until data is warmed up.
+    """
+    ready = utils.is_ready()
+    return Response(
+        helpers.dumps({'ready': ready, 'timings': utils.WARM_UP['timings']}),
+        status=200 if ready else 503,
+        mimetype='application/json'
+    )
+
+
+@app.route('/api/v1/cache_stats', methods=['GET'])
+@helpers.jsonify
+def cache_stats_view():
+    """
+    Returns data and response cache counters for monitoring.
+    """
+    return {
+        'data': utils.cache_stats(),
+        'responses': helpers.RESPONSE_CACHE.stats(),
+    }
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_view():
+    """
+    Request latency metrics for Prometheus.
+    """
+    return Response(
+        metrics.render(), mimetype='text/plain; version=0.0.4'
+    )